@@ -1,5 +1,4 @@
 from collections import Counter
-from sklearn.cluster import DBSCAN
 from sklearn.mixture import GaussianMixture
 import numpy as np
 import csv
@@ -20,6 +19,53 @@ def count_packet_sizes_from_csv(output_csv):
     for size, count in repeated_sizes.items():
         print(f"Size : {size} Bytes, Occure : {count}")
 
+def dbscan_1d(values, eps, min_samples):
+    # Exact 1-D DBSCAN, labelling like sklearn's DBSCAN(eps, min_samples):
+    # neighbourhoods are |x - y| <= eps including the point itself, clusters
+    # are numbered in order of their first core sample and a border sample
+    # joins the first numbered cluster that reaches it. Works on the sorted
+    # distinct values and their counts in linear sweeps.
+    values = np.asarray(values).ravel()
+    labels = np.full(len(values), -1, dtype=np.int64)
+    if len(values) == 0:
+        return labels
+    distinct, first_index, inverse, counts = np.unique(values, return_index=True, return_inverse=True,
+                                                       return_counts=True)
+    inverse = inverse.ravel()
+    cumulative = np.concatenate(([0], np.cumsum(counts)))
+    low = np.searchsorted(distinct, distinct - eps, side="left")
+    high = np.searchsorted(distinct, distinct + eps, side="right")
+    core = cumulative[high] - cumulative[low] >= min_samples
+    if not core.any():
+        return labels
+
+    # Consecutive core values closer than eps are density-connected
+    core_index = np.flatnonzero(core)
+    core_values = distinct[core_index]
+    component = np.concatenate(([0], np.cumsum(np.diff(core_values) > eps)))
+    # Clusters are numbered by the first sample, in input order, of their core values
+    discovery = np.full(component[-1] + 1, len(values))
+    np.minimum.at(discovery, component, first_index[core_index])
+    rank = np.empty(len(discovery), dtype=np.int64)
+    rank[np.argsort(discovery, kind="stable")] = np.arange(len(discovery))
+
+    distinct_labels = np.full(len(distinct), -1, dtype=np.int64)
+    distinct_labels[core_index] = rank[component]
+    # Border values take the lowest label of the core values within eps on either side
+    border = np.flatnonzero(~core)
+    left = np.searchsorted(core_values, distinct[border], side="right") - 1
+    right = left + 1
+    candidates = np.full((len(border), 2), len(values), dtype=np.int64)
+    reach_left = (left >= 0) & (distinct[border] - core_values[np.maximum(left, 0)] <= eps)
+    reach_right = (right < len(core_values)) & (
+        core_values[np.minimum(right, len(core_values) - 1)] - distinct[border] <= eps)
+    candidates[reach_left, 0] = rank[component[left[reach_left]]]
+    candidates[reach_right, 1] = rank[component[right[reach_right]]]
+    best = candidates.min(axis=1)
+    distinct_labels[border[best < len(values)]] = best[best < len(values)]
+    return distinct_labels[inverse]
+
+
 def apply_dbscan_clustering(input_csv, output_csv, eps, min_samples):
     data = []
     with open(input_csv, mode="r") as infile:
@@ -31,8 +77,7 @@ def apply_dbscan_clustering(input_csv, output_csv, eps, min_samples):
     #2D array
     data_array = np.array(data).reshape(-1, 1)
 
-    dbscan = DBSCAN(eps=eps, min_samples=min_samples)
-    labels = dbscan.fit_predict(data_array)
+    labels = dbscan_1d(data_array, eps, min_samples)
 
     #Write labels
     with open(input_csv, mode="r") as infile, open(output_csv, mode="w", newline="") as outfile:
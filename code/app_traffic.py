@@ -1,44 +1,255 @@
-import pyshark
+import bisect
 import csv
 import argparse
+import json
+import mmap
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import pcap_reader
+import pcap_index
+import flow_table
+import trace_file
 
-def extract_application_traffic(input_pcap, output_csv):
-    capture = pyshark.FileCapture(input_pcap, display_filter="tcp")
+CHUNK_SIZE = 64 << 20
+FOLLOW_BLOCK_SIZE = 16 << 20
+
+
+def _extract_chunk(input_pcap, state, start, end, idle_timeout):
+    table = flow_table.create_flow_table(idle_timeout, carry=True)
+    messages = []
+    first_timestamp = None
+    interfaces = list(state.get("interfaces", ()))
+    with open(input_pcap, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            pos = start
+            while pos < end:
+                packets, new_pos = pcap_reader.parse_packets(buf, pos, end, state)
+                if packets:
+                    if first_timestamp is None:
+                        first_timestamp = packets[0][0]
+                    flow_table.process_packets(table, packets, messages)
+                if new_pos == pos:
+                    break
+                pos = new_pos
+    # The chunk must end on a record boundary and use the interfaces read in the file preamble
+    consistent = pos == end and interfaces == state.get("interfaces", [])
+    return consistent, first_timestamp, messages, flow_table.chunk_summary(table)
 
-    application_traffic = []
-    current_packet_start_time = None
-    current_packet_size = 0
 
+def _extract_parallel(input_pcap, workers, idle_timeout):
+    if pcap_reader.detect_compression(input_pcap) is not None:
+        print("Compressed captures cannot be split, extracting sequentially.")
+        return None
+    with open(input_pcap, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            state, ranges = pcap_reader.split_capture(buf, CHUNK_SIZE)
+    if len(ranges) < 2:
+        return None
+
+    stitch_state = flow_table.create_stitch_state(idle_timeout)
+    application_traffic = []
     start_time = None
-    for packet in capture:
-        try:
-            tcp_layer = packet.tcp
-            current_packet_has_psh = int(tcp_layer.flags, 16) & 0x08 != 0
-            data_len = int(packet.tcp.len)
-            timestamp = float(packet.sniff_timestamp)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            _extract_chunk,
+            repeat(input_pcap), repeat(state),
+            [start for start, _ in ranges], [end for _, end in ranges],
+            repeat(idle_timeout))
+        for consistent, first_timestamp, messages, summary in results:
+            if not consistent:
+                print("Could not split the capture on record boundaries, falling back to a sequential extraction.")
+                return None
             if start_time is None:
-                start_time = timestamp
+                start_time = first_timestamp
+            flow_table.stitch_chunk(stitch_state, messages, summary, application_traffic)
+    return start_time, application_traffic
+
+
+def _open_window(input_pcaps, start):
+    # Returns (time origin, batches) reading the capture from the indexed
+    # record preceding start, or (None, batches) reading it from the beginning
+    if len(input_pcaps) > 1:
+        return None, pcap_reader.read_merged_tcp_batches(input_pcaps)
+    input_pcap = input_pcaps[0]
+    if start is not None and pcap_reader.detect_compression(input_pcap) is None:
+        index = pcap_index.load_index(input_pcap)
+        if index["seekable"] and index["first_timestamp"] is not None:
+            start_time = index["first_timestamp"]
+            offset = pcap_index.seek_offset(index, start_time + int(start * 1e9))
+            if offset is not None:
+                return start_time, pcap_reader.read_tcp_batches(input_pcap, index["state"], offset)
+    return None, pcap_reader.read_tcp_batches(input_pcap)
+
+
+def _extract_sequential(input_pcaps, idle_timeout, start=None, end=None):
+    table = flow_table.create_flow_table(idle_timeout)
+    application_traffic = []
+
+    start_time, batches = _open_window(input_pcaps, start)
+    for packets in batches:
+        if start_time is None:
+            start_time = packets[0][0]
+        if start is not None or end is not None:
+            low = start_time + int(start * 1e9) if start is not None else 0
+            high = start_time + int(end * 1e9) if end is not None else float("inf")
+            last_timestamp = packets[-1][0]
+            packets = [packet for packet in packets if low <= packet[0] <= high]
+            flow_table.process_packets(table, packets, application_traffic)
+            # Leave some slack for captures that are not perfectly ordered
+            if last_timestamp > high + pcap_index.INDEX_INTERVAL * 1e9:
+                break
+        else:
+            flow_table.process_packets(table, packets, application_traffic)
+    return start_time, application_traffic
+
+
+def _load_checkpoint(checkpoint_file, input_pcap):
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, "r") as f:
+        checkpoint = json.load(f)
+    if checkpoint["input"] != os.path.abspath(input_pcap) or os.path.getsize(input_pcap) < checkpoint["offset"]:
+        print(f"Ignoring {checkpoint_file}: it does not match {input_pcap}.")
+        return None
+    return checkpoint
 
-            relative_time = timestamp - start_time
 
-            if current_packet_start_time is None:
-                current_packet_start_time = relative_time
+def _save_checkpoint(checkpoint_file, checkpoint):
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
 
-            current_packet_size += data_len
 
-            if current_packet_has_psh:
-                application_traffic.append((current_packet_start_time, current_packet_size))
-                current_packet_start_time = None
-                current_packet_size = 0
+def follow_application_traffic(input_pcap, output_csv, idle_timeout=flow_table.DEFAULT_IDLE_TIMEOUT, poll_interval=1.0):
+    # Tails a growing capture and appends messages to output_csv in start
+    # time order. A complete message is held back while an earlier message is
+    # still open, at most idle_timeout seconds of capture time: a message
+    # still open after that is written out of order when it completes. The read
+    # offset, the reassembly state and the held messages are saved in
+    # output_csv.checkpoint after every read so that a restart resumes where
+    # the previous run stopped. Stops on Ctrl-C or when the capture shrinks.
+    if pcap_reader.detect_compression(input_pcap) is not None:
+        raise ValueError("Follow mode needs an uncompressed capture.")
+    if trace_file.is_trace_file(output_csv):
+        raise ValueError("Follow mode writes CSV traces only.")
 
-        except AttributeError:
-            continue
+    checkpoint_file = output_csv + ".checkpoint"
+    checkpoint = _load_checkpoint(checkpoint_file, input_pcap)
+    if checkpoint is None:
+        checkpoint = {
+            "input": os.path.abspath(input_pcap),
+            "offset": 0,
+            "output_size": 0,
+            "state": None,
+            "start_time": None,
+            "table": None,
+            "pending": [],
+        }
+        table = flow_table.create_flow_table(idle_timeout)
+        with open(output_csv, mode="w", newline="") as file:
+            csv.writer(file).writerow(["Time", "Size", "Flow", "Direction"])
+            checkpoint["output_size"] = file.tell()
+    else:
+        table = flow_table.load_flow_table(checkpoint["table"])
+        print(f"Resuming {input_pcap} at offset {checkpoint['offset']}")
 
-    with open(output_csv, mode="w", newline="") as file:
+    with open(input_pcap, "rb") as capture, open(output_csv, mode="r+", newline="") as file:
+        # Drop the rows written after the last checkpoint
+        file.truncate(checkpoint["output_size"])
+        file.seek(checkpoint["output_size"])
         writer = csv.writer(file)
-        writer.writerow(["Time","Size"])
-        for time, size in application_traffic:
-            writer.writerow([time, size])
+        state = checkpoint["state"]
+        try:
+            while True:
+                size = os.fstat(capture.fileno()).st_size
+                if size < checkpoint["offset"]:
+                    print(f"{input_pcap} was truncated, stopping.")
+                    break
+                capture.seek(checkpoint["offset"])
+                data = capture.read(min(size - checkpoint["offset"], FOLLOW_BLOCK_SIZE))
+                pos = 0
+                if state is None and len(data) >= 24:
+                    state, pos = pcap_reader.parse_header(data)
+                messages = [tuple(message) for message in checkpoint.get("pending", [])]
+                last_timestamp = None
+                while state is not None:
+                    packets, new_pos = pcap_reader.parse_packets(data, pos, len(data), state)
+                    if packets:
+                        if checkpoint["start_time"] is None:
+                            checkpoint["start_time"] = packets[0][0]
+                        last_timestamp = packets[-1][0]
+                        flow_table.process_packets(table, packets, messages)
+                    if new_pos == pos:
+                        break
+                    pos = new_pos
+                if pos == 0:
+                    time.sleep(poll_interval)
+                    continue
+
+                # Messages starting before every open message and every later
+                # packet are written, sorted like the batch extraction. Idle
+                # flows are evicted on every read so that their unfinished
+                # messages do not hold the output back.
+                messages.sort(key=lambda message: (message[0], message[2], message[3]))
+                if last_timestamp is not None:
+                    flow_table.evict_idle_flows(table, last_timestamp)
+                watermark = flow_table.open_message_start(table)
+                if last_timestamp is not None:
+                    watermark = last_timestamp if watermark is None else min(watermark, last_timestamp)
+                    watermark = max(watermark, last_timestamp - table["idle_timeout"])
+                ready = len(messages) if watermark is None else bisect.bisect_left(
+                    [message[0] for message in messages], watermark)
+
+                start_time = checkpoint["start_time"]
+                times = trace_file.format_times([message[0] - start_time for message in messages[:ready]])
+                for message_time, (_, message_size, flow, direction) in zip(times, messages[:ready]):
+                    writer.writerow([message_time, message_size, flow, direction])
+                file.flush()
+                checkpoint["pending"] = messages[ready:]
+                checkpoint["offset"] += pos
+                checkpoint["output_size"] = file.tell()
+                checkpoint["state"] = state
+                checkpoint["table"] = flow_table.save_flow_table(table)
+                _save_checkpoint(checkpoint_file, checkpoint)
+        except KeyboardInterrupt:
+            pass
+
+    print(f"Saved in {output_csv}")
+
+
+def extract_application_traffic(input_pcap, output_csv, idle_timeout=flow_table.DEFAULT_IDLE_TIMEOUT, workers=1, follow=False,
+                                start=None, end=None):
+    # input_pcap is a capture, a glob pattern or a list of them. Several
+    # captures are merged in timestamp order into a single message trace.
+    # start and end select a time window, in seconds after the first TCP packet.
+    input_pcaps = pcap_reader.expand_inputs(input_pcap)
+    if follow:
+        if len(input_pcaps) > 1:
+            raise ValueError("Follow mode reads a single capture.")
+        follow_application_traffic(input_pcaps[0], output_csv, idle_timeout)
+        return
+
+    result = None
+    if workers > 1 and len(input_pcaps) == 1 and start is None and end is None:
+        result = _extract_parallel(input_pcaps[0], workers, idle_timeout)
+    if result is None:
+        result = _extract_sequential(input_pcaps, idle_timeout, start, end)
+    start_time, application_traffic = result
+
+    messages = np.array(application_traffic, dtype=np.int64).reshape(-1, 4)
+    # Messages are completed in PSH order but timed by their first packet:
+    # rows are written in start time order, then by flow and direction
+    messages = messages[np.lexsort((messages[:, 3], messages[:, 2], messages[:, 0]))]
+    trace_file.save_trace(output_csv, {
+        "time": messages[:, 0] - (start_time or 0),
+        "size": messages[:, 1],
+        "flow": messages[:, 2],
+        "direction": messages[:, 3],
+    })
 
     print(f"Saved in {output_csv}")
 
@@ -52,18 +263,49 @@ def main():
     parser.add_argument(
         "--input", 
         type=str, 
+        nargs="+",
         required=True,
-        help="Path to the input file (PCAP)."
+        help="Path to the input file (PCAP or PCAPNG, optionally compressed with gzip, xz or zstd). "
+             "Several files or glob patterns are merged in timestamp order."
     )
     parser.add_argument(
         "--output", 
         type=str, 
         required=True,
-        help="Path to the output file."
+        help=f"Path to the output file (CSV, or binary trace with the {trace_file.TRACE_SUFFIX} suffix)."
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=flow_table.DEFAULT_IDLE_TIMEOUT,
+        help=f"Seconds of inactivity after which a connection is considered closed (default: {flow_table.DEFAULT_IDLE_TIMEOUT})."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes parsing chunks of the capture in parallel (default: 1)."
+    )
+
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Keep reading the capture as it grows and append new messages to the output."
+    )
+
+    parser.add_argument(
+        "--start",
+        type=float,
+        help="Only extract packets captured at least this many seconds after the first TCP packet."
+    )
+    parser.add_argument(
+        "--end",
+        type=float,
+        help="Only extract packets captured at most this many seconds after the first TCP packet."
     )
 
     args = parser.parse_args()
-    extract_application_traffic(args.input, args.output)
+    extract_application_traffic(args.input, args.output, args.idle_timeout, args.workers, args.follow, args.start, args.end)
 
 
 if __name__ == "__main__":
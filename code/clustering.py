@@ -1,19 +1,22 @@
 from collections import Counter
-from sklearn.cluster import DBSCAN
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from sklearn.mixture import GaussianMixture
 import numpy as np
-import csv
 import argparse
+import json
+import time
+import gmm1d
+import trace_file
 
+# "sklearn" fits every message, "weighted" runs gmm1d on the distinct sizes and their counts
+GMM_ENGINES = ("sklearn", "weighted")
+# Seed of the first bootstrap resample of gmm_stability, the next ones follow
+BOOTSTRAP_SEED = 42
 
-def count_packet_sizes_from_csv(output_csv):
-    size_counts = Counter()
 
-    with open(output_csv, mode="r") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            size = int(row["Size"])
-            size_counts[size] += 1
+def count_packet_sizes_from_csv(output_csv):
+    size_counts = Counter(trace_file.load_trace(output_csv)["size"].tolist())
     repeated_sizes = {size: count for size, count in size_counts.items() if count > 1}
 
     print(f"Packet sizes count : {len(size_counts)}")
@@ -21,83 +24,595 @@ def count_packet_sizes_from_csv(output_csv):
     for size, count in repeated_sizes.items():
         print(f"Size : {size} Bytes, Occure : {count}")
 
-def apply_gmm_clustering(input_csv, output_csv, max_components, min_cluster_size):
-    data = []
-    with open(input_csv, mode="r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            size = int(row["Size"])
-            data.append(size)
+def dbscan_1d(values, eps, min_samples):
+    # Exact 1-D DBSCAN, labelling like sklearn's DBSCAN(eps, min_samples):
+    # neighbourhoods are |x - y| <= eps including the point itself, clusters
+    # are numbered in order of their first core sample and a border sample
+    # joins the first numbered cluster that reaches it. Works on the sorted
+    # distinct values and their counts in linear sweeps.
+    values = np.asarray(values).ravel()
+    labels = np.full(len(values), -1, dtype=np.int64)
+    if len(values) == 0:
+        return labels
+    distinct, first_index, inverse, counts = np.unique(values, return_index=True, return_inverse=True,
+                                                       return_counts=True)
+    inverse = inverse.ravel()
+    cumulative = np.concatenate(([0], np.cumsum(counts)))
+    low = np.searchsorted(distinct, distinct - eps, side="left")
+    high = np.searchsorted(distinct, distinct + eps, side="right")
+    core = cumulative[high] - cumulative[low] >= min_samples
+    if not core.any():
+        return labels
+
+    # Consecutive core values closer than eps are density-connected
+    core_index = np.flatnonzero(core)
+    core_values = distinct[core_index]
+    component = np.concatenate(([0], np.cumsum(np.diff(core_values) > eps)))
+    # Clusters are numbered by the first sample, in input order, of their core values
+    discovery = np.full(component[-1] + 1, len(values))
+    np.minimum.at(discovery, component, first_index[core_index])
+    rank = np.empty(len(discovery), dtype=np.int64)
+    rank[np.argsort(discovery, kind="stable")] = np.arange(len(discovery))
+
+    distinct_labels = np.full(len(distinct), -1, dtype=np.int64)
+    distinct_labels[core_index] = rank[component]
+    # Border values take the lowest label of the core values within eps on either side
+    border = np.flatnonzero(~core)
+    left = np.searchsorted(core_values, distinct[border], side="right") - 1
+    right = left + 1
+    candidates = np.full((len(border), 2), len(values), dtype=np.int64)
+    reach_left = (left >= 0) & (distinct[border] - core_values[np.maximum(left, 0)] <= eps)
+    reach_right = (right < len(core_values)) & (
+        core_values[np.minimum(right, len(core_values) - 1)] - distinct[border] <= eps)
+    candidates[reach_left, 0] = rank[component[left[reach_left]]]
+    candidates[reach_right, 1] = rank[component[right[reach_right]]]
+    best = candidates.min(axis=1)
+    distinct_labels[border[best < len(values)]] = best[best < len(values)]
+    return distinct_labels[inverse]
+
+
+def k_distances(values, k):
+    # Distance of every distinct value to its k-th nearest sample, the sample
+    # itself included like NearestNeighbors(n_neighbors=k) on the training set.
+    # Returns (distinct values, counts, k-distances), inf when there are less than k samples.
+    distinct, counts = np.unique(np.asarray(values).ravel(), return_counts=True)
+    distinct = distinct.astype(np.float64)
+    n_distinct = len(distinct)
+    need = k - counts
+    distances = np.where(need <= 0, 0.0, np.inf)
+    left = np.arange(n_distinct) - 1
+    right = np.arange(n_distinct) + 1
+    active = np.flatnonzero(need > 0)
+    # Every step takes the nearest remaining distinct value on either side
+    while len(active):
+        l, r = left[active], right[active]
+        left_gap = np.where(l >= 0, distinct[active] - distinct[np.maximum(l, 0)], np.inf)
+        right_gap = np.where(r < n_distinct, distinct[np.minimum(r, n_distinct - 1)] - distinct[active], np.inf)
+        take_left = left_gap <= right_gap
+        gap = np.minimum(left_gap, right_gap)
+        exhausted = np.isinf(gap)
+        taken = np.where(take_left, counts[np.maximum(l, 0)], counts[np.minimum(r, n_distinct - 1)])
+        need[active] -= np.where(exhausted, 0, taken)
+        done = (need[active] <= 0) & ~exhausted
+        distances[active[done]] = gap[done]
+        left[active] = np.where(take_left, l - 1, l)
+        right[active] = np.where(take_left, r, r + 1)
+        active = active[~done & ~exhausted]
+    return distinct, counts, distances
+
+
+def suggest_eps(values, min_samples):
+    # Knee of the sorted k-distance curve (k = min_samples) of the distinct
+    # values: the point the farthest below the chord joining the ends of the
+    # normalised curve. Repeated sizes would otherwise flatten the curve at 0.
+    _, _, distances = k_distances(values, min_samples)
+    curve = np.sort(distances[np.isfinite(distances)])
+    if len(curve) == 0:
+        return None
+    span = curve[-1] - curve[0]
+    if span == 0:
+        return float(curve[0])
+    position = np.arange(1, len(curve) + 1) / len(curve)
+    knee = np.argmax(position - (curve - curve[0]) / span)
+    return float(curve[knee])
+
+
+def apply_dbscan_clustering(input_csv, output_csv, eps, min_samples, partition=False):
+    trace = trace_file.load_trace(input_csv)
+    labels = dbscan_1d(trace["size"], eps, min_samples)
+
+    trace["label"], trace["labels"] = trace_file.encode_labels(labels)
+    trace_file.save_trace(output_csv, trace, partition)
+
+    unique_labels = set(labels.tolist())
+    print("Clusters :")
+    for label in unique_labels:
+        if label == -1:
+            print(f"Cluster {label} : Noise")
+        else:
+            print(f"Cluster {label}")
 
-    data_array = np.array(data).reshape(-1, 1)
 
+# Data of the GMM sweep or of the bootstrap resamples in the worker
+# processes, set by _init_sweep_worker
+_sweep_data = None
+
+
+def _init_sweep_worker(data):
+    global _sweep_data
+    _sweep_data = data
+
+
+def mixture_parameters(gmm, engine):
+    # {"means", "variances", "weights"} arrays of a fitted model of either engine
+    if engine == "weighted":
+        return {name: gmm[name] for name in ("means", "variances", "weights")}
+    return {
+        "means": gmm.means_.ravel(),
+        "variances": gmm.covariances_.ravel(),
+        "weights": gmm.weights_,
+    }
+
+
+def _fit_gmm(n_components, engine, data=None, init=None):
+    # data is the (n, 1) sizes array for sklearn and (values, counts) for the
+    # weighted engine. init is a mixture_parameters dict to start EM from.
+    # Returns (n_components, model, BIC, seconds, EM iterations, converged).
+    if data is None:
+        data = _sweep_data
+    start = time.perf_counter()
+    if engine == "weighted":
+        gmm = gmm1d.fit(data[0], data[1], n_components, init=init)
+        bic = gmm1d.bic(gmm, data[0], data[1])
+        n_iter, converged = gmm["n_iter"], gmm["converged"]
+    else:
+        if init is None:
+            gmm = GaussianMixture(n_components=n_components, random_state=42)
+        else:
+            gmm = GaussianMixture(n_components=n_components, random_state=42, weights_init=init["weights"],
+                                  means_init=init["means"].reshape(-1, 1),
+                                  precisions_init=(1 / init["variances"]).reshape(-1, 1, 1))
+        gmm.fit(data)
+        bic = gmm.bic(data)
+        n_iter, converged = gmm.n_iter_, gmm.converged_
+    return n_components, gmm, bic, time.perf_counter() - start, n_iter, converged
+
+
+def _sweep_fits(data, max_components, workers, engine, warm_start=False):
+    # Yields the fits of 1..max_components components in order. With several
+    # workers, up to workers fits run ahead in a process pool and the pending
+    # ones are cancelled when the caller stops consuming.
+    #
+    # With warm_start, every fit starts from the previous solution with its
+    # widest component split in two. The fits depend on each other and run in turn.
+    if warm_start:
+        init = None
+        for n_components in range(1, max_components + 1):
+            fit = _fit_gmm(n_components, engine, data, init)
+            init = gmm1d.split_widest(mixture_parameters(fit[1], engine))
+            yield fit
+        return
+    if workers <= 1:
+        for n_components in range(1, max_components + 1):
+            yield _fit_gmm(n_components, engine, data)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker,
+                             initargs=(data,)) as executor:
+        pending = []
+        next_components = 1
+        try:
+            while pending or next_components <= max_components:
+                while len(pending) < workers and next_components <= max_components:
+                    pending.append(executor.submit(_fit_gmm, next_components, engine))
+                    next_components += 1
+                yield pending.pop(0).result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def select_gmm(data, max_components, workers=1, patience=None, engine="sklearn", warm_start=False, verbose=True):
+    # BIC sweep over 1..max_components components. With patience, the sweep
+    # stops once BIC has not improved for patience consecutive component counts.
     best_gmm = None
     best_bic = float("inf")
     best_n_components = 1
+    sweep_start = time.perf_counter()
+    if warm_start and workers > 1 and verbose:
+        print("Warm-started fits depend on each other, running the sweep in a single process.")
 
-    for n_components in range(1, max_components + 1):
-        gmm = GaussianMixture(n_components=n_components, random_state=42)
-        gmm.fit(data_array)
-        bic = gmm.bic(data_array)
+    for n_components, gmm, bic, elapsed, n_iter, converged in _sweep_fits(data, max_components, workers, engine,
+                                                                          warm_start):
+        if verbose:
+            status = "" if converged else ", not converged"
+            print(f"{n_components} components : BIC {bic:.2f} ({elapsed:.2f}s, {n_iter} EM iterations{status})")
         if bic < best_bic:
             best_bic = bic
             best_gmm = gmm
             best_n_components = n_components
+        elif patience is not None and n_components - best_n_components >= patience:
+            if verbose:
+                print(f"No BIC improvement for {patience} component counts, stopping the sweep.")
+            break
 
-    print(f"Optimal number of clusters : {best_n_components}")
+    if verbose:
+        print(f"BIC sweep done in {time.perf_counter() - sweep_start:.2f}s")
+    return best_gmm, best_n_components
 
-    labels = best_gmm.predict(data_array)
 
-    cluster_counts = Counter(labels)
+def small_cluster_mapping(labels, n_clusters, min_cluster_size, weights=None):
+    # Target of every cluster: itself, or None for the clusters with less
+    # than min_cluster_size messages whose messages go to the nearest mean.
+    # weights are the message counts of labels given per distinct size.
+    counts = np.bincount(labels, weights=weights, minlength=n_clusters)
+    # Empty components (count 0) are not small: like in the former loop over
+    # the clusters, they stay surviving targets of remap_labels
+    small = (counts > 0) & (counts < min_cluster_size)
+    if small.all():
+        return list(range(n_clusters))
+    return [None if is_small else cluster for cluster, is_small in enumerate(small.tolist())]
 
-    # identify small clusters
-    small_clusters = [cluster for cluster, count in cluster_counts.items() if count < min_cluster_size]
 
-    # merge small clusters
-    for i, label in enumerate(labels):
-        if label in small_clusters:
-            distances = np.linalg.norm(data_array[i] - best_gmm.means_, axis=1)
-            nearest_cluster = np.argmin(distances)
-            while nearest_cluster in small_clusters:
-                distances[nearest_cluster] = float("inf")
-                nearest_cluster = np.argmin(distances)
-            labels[i] = nearest_cluster
+def iterative_mapping(values, labels, min_cluster_size, weights=None):
+    # Merges the smallest cluster under min_cluster_size into the cluster
+    # with the nearest mean size, updating the means, until every cluster
+    # reaches min_cluster_size or a single cluster is left
+    n_clusters = labels.max() + 1 if len(labels) else 0
+    counts = np.bincount(labels, weights=weights, minlength=n_clusters)
+    sums = np.bincount(labels, weights=values if weights is None else values * weights, minlength=n_clusters)
+    alive = counts > 0
+    mapping = np.arange(n_clusters)
+    while np.count_nonzero(alive) > 1:
+        candidates = np.flatnonzero(alive & (counts < min_cluster_size))
+        if len(candidates) == 0:
+            break
+        cluster = candidates[np.argmin(counts[candidates])]
+        alive[cluster] = False
+        others = np.flatnonzero(alive)
+        means = sums[others] / counts[others]
+        target = others[np.argmin(np.abs(means - sums[cluster] / counts[cluster]))]
+        mapping[mapping == cluster] = target
+        counts[target] += counts[cluster]
+        sums[target] += sums[cluster]
+    return mapping.tolist()
+
 
-    cluster_counts = Counter(labels)
+def remap_labels(values, labels, means, mapping):
+    # Applies a cluster mapping. The messages of the clusters mapped to None
+    # go to the surviving cluster whose mean is the nearest to their size,
+    # computed once per distinct size.
+    targets = np.array([-1 if target is None else target for target in mapping], dtype=np.int64)
+    labels = targets[labels] if len(targets) else labels.copy()
+    moved = labels == -1
+    if moved.any():
+        surviving = np.flatnonzero(targets == np.arange(len(targets)))
+        sizes, inverse = np.unique(values[moved], return_inverse=True)
+        nearest = surviving[np.abs(sizes[:, None] - means[surviving]).argmin(axis=1)]
+        labels[moved] = nearest[inverse.ravel()]
+    return labels
+
+
+def merge_mapping(values, counts, components, n_components, min_cluster_size, iterative_merge=False):
+    # Merge mapping of the components of the distinct sizes values, seen counts times
+    if iterative_merge:
+        return iterative_mapping(values, components, min_cluster_size, counts)
+    return small_cluster_mapping(components, n_components, min_cluster_size, counts)
+
+
+def predict_components(gmm, engine, values):
+    # Mixture component of every distinct size under a model of either engine
+    if engine == "weighted":
+        return gmm1d.predict(gmm, values)
+    return gmm.predict(values.reshape(-1, 1))
+
+
+def merge_small_clusters(values, labels, means, min_cluster_size):
+    # Moves the messages of the clusters with less than min_cluster_size
+    # messages to the cluster whose mean is the nearest to their size
+    return remap_labels(values, labels, means, small_cluster_mapping(labels, len(means), min_cluster_size))
+
+
+def merge_clusters_iteratively(values, labels, min_cluster_size):
+    return np.asarray(iterative_mapping(values, labels, min_cluster_size), dtype=np.int64)[labels]
+
+
+def save_model(model_file, model):
+    with open(model_file, "w") as f:
+        json.dump(model, f, indent=4)
+    print(f"Model saved in {model_file}")
+
+
+def load_model(model_file):
+    with open(model_file, "r") as f:
+        model = json.load(f)
+    if model.get("type") != "gmm":
+        raise ValueError(f"Unsupported clustering model in {model_file}: {model.get('type')}")
+    for name in ("means", "variances", "weights"):
+        model[name] = np.asarray(model[name], dtype=np.float64)
+    return model
+
+
+def predict_labels(model, sizes):
+    # Labels of sizes under a fitted model: mixture component, then the merge mapping
+    values, inverse = np.unique(np.asarray(sizes).ravel(), return_inverse=True)
+    components = gmm1d.predict(model, values.astype(np.float64))
+    return remap_labels(values, components, model["means"], model["merge_mapping"])[inverse.ravel()]
+
+
+def read_sizes(input_csv):
+    # Sizes of every message in trace order as a float64 (n, 1) array.
+    # Float sizes: some scikit-learn releases score integer arrays incorrectly in predict
+    sizes = [np.asarray(chunk["size"], dtype=np.float64) for chunk in trace_file.iter_trace_chunks(input_csv)]
+    return np.concatenate(sizes or [np.zeros(0)]).reshape(-1, 1)
+
+
+def size_counts(input_csv):
+    # Distinct sizes of a trace and their counts, merged chunk by chunk
+    values = np.zeros(0)
+    counts = np.zeros(0)
+    for chunk in trace_file.iter_trace_chunks(input_csv):
+        chunk_values, chunk_counts, _ = gmm1d.unique_counts(chunk["size"])
+        values, inverse = np.unique(np.concatenate((values, chunk_values)), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=np.concatenate((counts, chunk_counts)), minlength=len(values))
+    return values, counts
+
+
+def label_trace(input_csv, output_csv, label_sizes, partition=False):
+    # Streams the input by blocks of trace_file.CHUNK_ROWS rows, labels every
+    # block with label_sizes(sizes) and writes it, so that memory does not
+    # grow with the length of the trace
+    label_codes = {}
+    labels = []
+    cluster_counts = np.zeros(0, dtype=np.int64)
+
+    def labelled_chunks():
+        nonlocal cluster_counts
+        for chunk in trace_file.iter_trace_chunks(input_csv):
+            chunk["label"] = trace_file.encode_chunk_labels(label_sizes(chunk["size"]), label_codes, labels)
+            chunk["labels"] = list(labels)
+            chunk_counts = np.bincount(chunk["label"], minlength=len(labels))
+            chunk_counts[:len(cluster_counts)] += cluster_counts
+            cluster_counts = chunk_counts
+            yield chunk
+
+    trace_file.save_trace_chunks(output_csv, labelled_chunks(), partition)
 
     print("Clusters  :")
-    for cluster, count in cluster_counts.items():
+    for cluster, count in zip(labels, cluster_counts.tolist()):
         print(f"Cluster {cluster}: {count} elements")
 
-    with open(input_csv, mode="r") as infile, open(output_csv, mode="w", newline="") as outfile:
-        reader = csv.DictReader(infile)
-        fieldnames = reader.fieldnames + ["Label"]
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
 
-        writer.writeheader()
-        for row, label in zip(reader, labels):
-            row["Label"] = label
-            writer.writerow(row)
+def apply_clustering_model(input_csv, output_csv, model_file, partition=False):
+    # Labels a trace with a model saved by apply_gmm_clustering, without fitting
+    model = load_model(model_file)
+    label_trace(input_csv, output_csv, lambda sizes: predict_labels(model, sizes), partition)
+
+
+def stratified_sample(values, counts, budget):
+    # budget sizes taken at evenly spaced ranks of the sorted sizes, so that
+    # every size quantile is represented in proportion. The sizes are given
+    # as distinct values and their counts.
+    ranks = (np.arange(budget) + 0.5) * counts.sum() / budget
+    return values[np.searchsorted(np.cumsum(counts), ranks.astype(np.int64), side="right")]
+
+
+def report_sample_fit(mixture, fit_values, values, counts):
+    # Mean log-likelihood per message of the model on its fit sample and on the full trace
+    sample_values, sample_counts, _ = gmm1d.unique_counts(fit_values)
+    sample_score = gmm1d.log_likelihood(mixture, sample_values, sample_counts) / sample_counts.sum()
+    full_score = gmm1d.log_likelihood(mixture, values, counts) / counts.sum()
+    print(f"Log-likelihood per message : sample {sample_score:.6f}, full trace {full_score:.6f} "
+          f"(gap {sample_score - full_score:.6f})")
+
+
+def fit_gmm_labels(input_csv, max_components, min_cluster_size, workers=1, patience=None, engine="sklearn",
+                   iterative_merge=False, fit_sample=None, warm_start=False, verbose=True):
+    # GMM labelling of the distinct sizes of a trace, as written by
+    # apply_gmm_clustering. fit_sample bounds the number of messages the
+    # candidates are fitted on: larger traces are fitted on a stratified sample.
+    # Returns (distinct sizes, counts, label of every size, model).
+    if engine not in GMM_ENGINES:
+        raise ValueError(f"Unknown GMM engine: {engine}. Available engines: {list(GMM_ENGINES)}")
+    # The fit and the merge work on the distinct sizes, the labels of the
+    # messages are then written by a streaming pass over the trace.
+    if engine == "sklearn" and fit_sample is None:
+        data_array = read_sizes(input_csv)
+        values, counts, _ = gmm1d.unique_counts(data_array)
+    else:
+        values, counts = size_counts(input_csv)
+
+    fit_values = None
+    if fit_sample is not None and counts.sum() > fit_sample:
+        fit_values = stratified_sample(values, counts, fit_sample)
+        if verbose:
+            print(f"Fitting on a stratified sample of {len(fit_values)} out of {int(counts.sum())} messages")
+
+    if engine == "weighted":
+        fit_data = (values, counts)
+        if fit_values is not None:
+            sample_values, sample_counts, _ = gmm1d.unique_counts(fit_values)
+            # Sample counts scaled to the trace, the BIC is that of the full trace size
+            fit_data = (sample_values, sample_counts * (counts.sum() / len(fit_values)))
+        if verbose:
+            print(f"Fitting {len(fit_data[0])} distinct sizes")
+        best_gmm, best_n_components = select_gmm(fit_data, max_components, workers, patience, engine, warm_start,
+                                                 verbose)
+    else:
+        if fit_values is not None:
+            data_array = fit_values.reshape(-1, 1)
+        elif fit_sample is not None:
+            # The trace is within the budget, it is fitted on every message as without fit_sample
+            data_array = read_sizes(input_csv)
+        best_gmm, best_n_components = select_gmm(data_array, max_components, workers, patience, engine, warm_start,
+                                                 verbose)
+        # Only the distinct sizes are needed from here on
+        del data_array
+    components = predict_components(best_gmm, engine, values)
+    mixture = mixture_parameters(best_gmm, engine)
+
+    if verbose:
+        print(f"Optimal number of clusters : {best_n_components}")
+        if fit_values is not None:
+            report_sample_fit(mixture, fit_values, values, counts)
+
+    # merge small clusters
+    mapping = merge_mapping(values, counts, components, best_n_components, min_cluster_size, iterative_merge)
+    size_labels = remap_labels(values, components, mixture["means"], mapping)
+    model = {
+        "type": "gmm",
+        "means": mixture["means"].tolist(),
+        "variances": mixture["variances"].tolist(),
+        "weights": mixture["weights"].tolist(),
+        "merge_mapping": mapping,
+    }
+    return values, counts, size_labels, model
+
+
+def apply_gmm_clustering(input_csv, output_csv, max_components, min_cluster_size, partition=False,
+                         workers=1, patience=None, engine="sklearn", iterative_merge=False, model_file=None,
+                         fit_sample=None, warm_start=False):
+    values, _, size_labels, model = fit_gmm_labels(input_csv, max_components, min_cluster_size, workers, patience,
+                                                   engine, iterative_merge, fit_sample, warm_start)
+
+    if model_file:
+        model["parameters"] = {
+            "max_components": max_components,
+            "min_cluster_size": min_cluster_size,
+            "engine": engine,
+            "patience": patience,
+            "iterative_merge": iterative_merge,
+            "fit_sample": fit_sample,
+            "warm_start": warm_start,
+        }
+        save_model(model_file, model)
+
+    label_trace(input_csv, output_csv, lambda sizes: size_labels[np.searchsorted(values, sizes)], partition)
+
+
+def _fit_size_labels(values, counts, max_components, min_cluster_size, engine, patience, iterative_merge,
+                     warm_start):
+    # Quiet single-process GMM labelling of the distinct sizes values seen
+    # counts times. Returns (number of components, label of every size).
+    present = counts > 0
+    if engine == "weighted":
+        data = (values[present], counts[present])
+    else:
+        data = np.repeat(values, counts.astype(np.int64)).reshape(-1, 1)
+    gmm, n_components = select_gmm(data, max_components, 1, patience, engine, warm_start, verbose=False)
+    components = predict_components(gmm, engine, values)
+    mapping = merge_mapping(values, counts, components, n_components, min_cluster_size, iterative_merge)
+    return n_components, remap_labels(values, components, mixture_parameters(gmm, engine)["means"], mapping)
+
+
+def _bootstrap_replicate(seed, parameters, data=None):
+    # Labels of the distinct sizes fitted on a resample with replacement of
+    # the messages, drawn as multinomial counts over the distinct sizes
+    if data is None:
+        data = _sweep_data
+    values, counts = data
+    rng = np.random.default_rng(seed)
+    resample = rng.multinomial(int(counts.sum()), counts / counts.sum()).astype(np.float64)
+    return _fit_size_labels(values, resample, *parameters)
+
+
+def cluster_jaccard(reference, labels, counts):
+    # Largest Jaccard index of every reference cluster with a cluster of
+    # labels, the sizes weighted by their message counts
+    reference_ids, reference = np.unique(reference, return_inverse=True)
+    label_ids, labels = np.unique(labels, return_inverse=True)
+    joint = np.bincount(reference.ravel() * len(label_ids) + labels.ravel(), weights=counts,
+                        minlength=len(reference_ids) * len(label_ids)).reshape(len(reference_ids), -1)
+    union = joint.sum(axis=1)[:, None] + joint.sum(axis=0)[None, :] - joint
+    return reference_ids, (joint / union).max(axis=1)
+
+
+def gmm_stability(input_csv, output_json, max_components, min_cluster_size, n_bootstrap, workers=1, patience=None,
+                  engine="sklearn", iterative_merge=False, warm_start=False, seed=BOOTSTRAP_SEED):
+    # Bootstrap stability of the GMM labelling: the labelling is repeated on
+    # n_bootstrap resamples of the messages, in parallel on the distinct
+    # sizes and their counts. Every cluster of the labelling of the full trace
+    # is scored by its mean Jaccard index with the closest resample cluster
+    # (below 0.5 it dissolved), and the selected number of components is summarised.
+    if engine not in GMM_ENGINES:
+        raise ValueError(f"Unknown GMM engine: {engine}. Available engines: {list(GMM_ENGINES)}")
+    if n_bootstrap < 1:
+        raise ValueError(f"Invalid number of bootstrap resamples: {n_bootstrap}")
+    parameters = (max_components, min_cluster_size, engine, patience, iterative_merge, warm_start)
+    start = time.perf_counter()
+    # The reference is the labelling written by apply_gmm_clustering, fitted on the trace itself
+    values, counts, reference, model = fit_gmm_labels(input_csv, max_components, min_cluster_size, workers, patience,
+                                                      engine, iterative_merge, warm_start=warm_start, verbose=False)
+    n_reference = len(model["means"])
+
+    seeds = [seed + replicate for replicate in range(n_bootstrap)]
+    if workers <= 1:
+        replicates = [_bootstrap_replicate(replicate_seed, parameters, (values, counts)) for replicate_seed in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker,
+                                 initargs=((values, counts),)) as executor:
+            replicates = list(executor.map(_bootstrap_replicate, seeds, repeat(parameters)))
+    print(f"{n_bootstrap} bootstrap resamples fitted in {time.perf_counter() - start:.2f}s")
+
+    n_components = np.array([n for n, _ in replicates])
+    scores = np.array([cluster_jaccard(reference, labels, counts)[1] for _, labels in replicates])
+    cluster_ids = np.unique(reference)
+    messages = np.bincount(np.searchsorted(cluster_ids, reference), weights=counts, minlength=len(cluster_ids))
+
+    report = {
+        "bootstrap": n_bootstrap,
+        "seed": seed,
+        "components": {
+            "reference": n_reference,
+            "resamples": n_components.tolist(),
+            "mean": float(n_components.mean()),
+            "std": float(n_components.std()),
+            "min": int(n_components.min()),
+            "max": int(n_components.max()),
+        },
+        "clusters": {},
+    }
+    print(f"Components : {n_reference} on the full trace, {n_components.mean():.2f} +/- {n_components.std():.2f} "
+          f"({n_components.min()}-{n_components.max()}) on the resamples")
+    for index, cluster in enumerate(cluster_ids.tolist()):
+        cluster_scores = scores[:, index]
+        dissolved = int(np.count_nonzero(cluster_scores < 0.5))
+        report["clusters"][str(cluster)] = {
+            "messages": int(messages[index]),
+            "mean_jaccard": float(cluster_scores.mean()),
+            "min_jaccard": float(cluster_scores.min()),
+            "dissolved": dissolved,
+        }
+        print(f"Cluster {cluster}: {int(messages[index])} elements, mean Jaccard {cluster_scores.mean():.3f}, "
+              f"dissolved in {dissolved}/{n_bootstrap} resamples")
+
+    with open(output_json, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved in {output_json}")
 
 
 def main():
     parser = argparse.ArgumentParser(
         description=(
-            "This script provide functions to apply GMM clustering on a traffic trace. "
+            "This script provide functions to apply GMM or DBSCAN clustering on a traffic trace. "
         )
     )
     parser.add_argument(
         "--input", 
         type=str, 
         required=True,
-        help="Path to the input file (CSV)."
+        help="Path to the input file (CSV or binary trace)."
     )
     parser.add_argument(
         "--output", 
         type=str, 
         required=True,
-        help="Path to the output file."
+        help="Path to the output file (CSV or binary trace)."
     )
+    parser.add_argument(
+        "--algorithm", 
+        choices=["gmm", "dbscan"], 
+        default="gmm", 
+        help="Clustering algorithm (default: gmm).")
     parser.add_argument(
         "--max-components", 
         type=int, 
@@ -108,10 +623,81 @@ def main():
         type=int, 
         default=100, 
         help="Minimum cluster size for the GMM clustering algorithm (default: 2).")
+    parser.add_argument(
+        "--workers", 
+        type=int, 
+        default=1, 
+        help="Number of processes fitting the GMM candidates in parallel (default: 1).")
+    parser.add_argument(
+        "--patience", 
+        type=int, 
+        help="Stop the BIC sweep after this many component counts without improvement.")
+    parser.add_argument(
+        "--engine", 
+        choices=GMM_ENGINES, 
+        default="sklearn", 
+        help="GMM fitter: sklearn on every message (default) or weighted EM on the distinct sizes.")
+    parser.add_argument(
+        "--iterative-merge", 
+        action="store_true", 
+        help="Merge the smallest cluster into the nearest one and repeat until every cluster reaches the minimum size.")
+    parser.add_argument(
+        "--eps", 
+        type=float, 
+        default=100, 
+        help="The epsilon parameter for the DBSCAN clustering algorithm (default: 100).")
+    parser.add_argument(
+        "--min-samples", 
+        type=int, 
+        default=5, 
+        help="The minimum samples parameter for the DBSCAN clustering algorithm (default: 5).")
+    parser.add_argument(
+        "--suggest-eps", 
+        action="store_true", 
+        help="DBSCAN: use the knee of the k-distance curve as epsilon.")
+    parser.add_argument(
+        "--warm-start", 
+        action="store_true", 
+        help="Start every GMM candidate from the previous one with its widest component split in two.")
+    parser.add_argument(
+        "--bootstrap", 
+        type=int, 
+        help="Instead of labelling the input, fit the GMM labelling on this many bootstrap resamples and save "
+             "the stability of every cluster to the output (JSON).")
+    parser.add_argument(
+        "--fit-sample", 
+        type=int, 
+        help="Fit the GMM candidates on a stratified sample of at most this many messages, then label the whole trace.")
+    parser.add_argument(
+        "--save-model", 
+        type=str, 
+        help="GMM: save the fitted model and merge mapping to this JSON file.")
+    parser.add_argument(
+        "--apply-model", 
+        type=str, 
+        help="Label the input with a model saved by --save-model instead of fitting one.")
+    parser.add_argument(
+        "--partition-labels", 
+        action="store_true", 
+        help="Group the rows of the binary output trace by label so that single sub-flow queries only read their rows.")
 
 
     args = parser.parse_args()
-    apply_gmm_clustering(args.input, args.output, args.max_components, args.min_cluster_size)
+    if args.bootstrap is not None:
+        gmm_stability(args.input, args.output, args.max_components, args.min_cluster_size, args.bootstrap,
+                      args.workers, args.patience, args.engine, args.iterative_merge, args.warm_start)
+    elif args.apply_model:
+        apply_clustering_model(args.input, args.output, args.apply_model, args.partition_labels)
+    elif args.algorithm == "dbscan":
+        eps = args.eps
+        if args.suggest_eps:
+            eps = suggest_eps(trace_file.load_trace(args.input)["size"], args.min_samples)
+            print(f"Suggested epsilon : {eps}")
+        apply_dbscan_clustering(args.input, args.output, eps, args.min_samples, args.partition_labels)
+    else:
+        apply_gmm_clustering(args.input, args.output, args.max_components, args.min_cluster_size, args.partition_labels,
+                             args.workers, args.patience, args.engine, args.iterative_merge, args.save_model,
+                             args.fit_sample, args.warm_start)
 
 
 if __name__ == "__main__":
@@ -1,119 +1,110 @@
-import csv
 import json
-from collections import defaultdict
-from typing import List
+from typing import Dict, List
 import argparse
-
-def generate_distribution(values: List[float], interval: float) -> List[Dict[str, float]]:
-    min_value = min(values)
-    max_value = max(values)
-
-    slots = []
-    current_min = min_value // interval * interval
-    while current_min <= max_value:
-        slots.append(current_min)
-        current_min += interval
-
-    slot_ranges = {}
-    for slot_min in slots:
-        slot_max = slot_min + interval
-        slot_ranges[(slot_min, slot_max)] = []
-
-    for value in values:
-        for slot_min, slot_max in slot_ranges.keys():
-            if slot_min <= value < slot_max:
-                slot_ranges[(slot_min, slot_max)].append(value)
-                break
-
-    total_values = len(values)
+import numpy as np
+import trace_file
+
+def add_to_bins(bins, values, interval):
+    # Updates bins, {slot index: [min, max, count]}, with the values of a
+    # NumPy array. Slot k covers [k * interval, (k + 1) * interval).
+    if len(values) == 0:
+        return
+    slots = np.floor_divide(values, interval).astype(np.int64)
+    order = np.argsort(slots, kind="stable")
+    slots = slots[order]
+    values = values[order]
+    starts = np.flatnonzero(np.concatenate(([True], slots[1:] != slots[:-1])))
+    counts = np.diff(np.append(starts, len(values)))
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+    for slot, slot_min, slot_max, count in zip(slots[starts].tolist(), mins.tolist(), maxs.tolist(), counts.tolist()):
+        current = bins.get(slot)
+        if current is None:
+            bins[slot] = [slot_min, slot_max, count]
+        else:
+            current[0] = min(current[0], slot_min)
+            current[1] = max(current[1], slot_max)
+            current[2] += count
+
+def bins_distribution(bins, total_values):
     distribution = []
-    for (slot_min, slot_max), slot_values in slot_ranges.items():
-        if slot_values:
-            actual_min = min(slot_values)
-            actual_max = max(slot_values)
-            prob = len(slot_values) / total_values
-            distribution.append({
-                "min": actual_min,
-                "max": actual_max,
-                "proba": prob
-            })
+    for slot in sorted(bins):
+        actual_min, actual_max, count = bins[slot]
+        distribution.append({
+            "min": actual_min,
+            "max": actual_max,
+            "proba": count / total_values
+        })
     distribution.sort(key=lambda x: x["proba"], reverse=True)
 
     return distribution
 
-def sub_flow_distribution(input_file, output_file, flow_num, time_bin, size_bin):
-    sub_flows = defaultdict(list)
-
-    with open(input_file, mode="r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            label = row["Label"]
-            timestamp = float(row["Time"]) * 1000  # Conversion en ms
-            size = int(row["Size"])
-            sub_flows[label].append((timestamp, size))
-
-    if flow_num not in sub_flows:
-        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {list(sub_flows.keys())}")
-
-    flow = sub_flows[flow_num]
-
-    if not flow or len(flow) < 2:
-        raise ValueError(f"Flow {flow_num} must contain at least two packets to analyze inter-packet times.")
-    timestamps = [packet[0] for packet in flow]
-    packet_sizes = [packet[1] for packet in flow]
+def generate_distribution(values: List[float], interval: float) -> List[Dict[str, float]]:
+    bins = {}
+    add_to_bins(bins, np.asarray(values), interval)
+    return bins_distribution(bins, len(values))
+
+def accumulate_sub_flows(input_file, time_bin, size_bin, flow_num=None):
+    # Streams the trace by chunks and bins the sizes and inter-packet times of
+    # every sub-flow (or only flow_num), without keeping the messages.
+    # Returns the labels of the trace and {label code: accumulator}.
+    flows = {}
+    labels = []
+    for chunk in trace_file.iter_trace_chunks(input_file, label=flow_num):
+        labels = chunk["labels"]
+        codes = chunk["label"]
+        timestamps = chunk["time"]  # in ns
+        sizes = chunk["size"]
+        if len(codes) == 0:
+            continue
+
+        order = np.argsort(codes, kind="stable")
+        codes, timestamps, sizes = codes[order], timestamps[order], sizes[order]
+        bounds = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1], [True])))
+        for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            flow = flows.setdefault(int(codes[start]), {
+                "count": 0,
+                "last_time": None,
+                "time_bins": {},
+                "size_bins": {},
+            })
+            flow_times = timestamps[start:stop]
+            if flow["last_time"] is not None:
+                flow_times = np.concatenate(([flow["last_time"]], flow_times))
+            add_to_bins(flow["time_bins"], np.diff(flow_times) / trace_file.NS_PER_MS, time_bin)
+            add_to_bins(flow["size_bins"], sizes[start:stop], size_bin)
+            flow["count"] += stop - start
+            flow["last_time"] = flow_times[-1]
+    return labels, flows
+
+def flow_distribution(label, flow):
+    if flow["count"] < 2:
+        raise ValueError(f"Flow {label} must contain at least two packets to analyze inter-packet times.")
+    return {
+        "label": label,
+        "type": "distribution",
+        "inter-packet-times": bins_distribution(flow["time_bins"], flow["count"] - 1),
+        "packet-sizes": bins_distribution(flow["size_bins"], flow["count"])
+    }
 
-    inter_packet_times = [
-        timestamps[i + 1] - timestamps[i]
-        for i in range(len(timestamps) - 1)
-    ]
+def sub_flow_distribution(input_file, output_file, flow_num, time_bin, size_bin):
+    labels, flows = accumulate_sub_flows(input_file, time_bin, size_bin, flow_num)
 
-    inter_packet_distribution = generate_distribution(inter_packet_times, time_bin)
-    size_distribution = generate_distribution(packet_sizes, size_bin)
+    if flow_num not in labels:
+        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {labels}")
 
-    results = {
-        "label": flow_num,
-        "type": "distribution",
-        "inter-packet-times": inter_packet_distribution,
-        "packet-sizes": size_distribution
-    }
+    results = flow_distribution(flow_num, flows[labels.index(flow_num)])
 
     with open(output_file, "w") as json_file:
         json.dump({"sub-flow": results}, json_file, indent=4)
 
 def sub_flows_distribution(input_file, output_file, time_bin, size_bin):
-    sub_flows = defaultdict(list)
-
-    with open(input_file, mode="r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            label = row["Label"]
-            timestamp = float(row["Time"]) * 1000  # Conversion en ms
-            size = int(row["Size"])
-            sub_flows[label].append((timestamp, size))
+    labels, flows = accumulate_sub_flows(input_file, time_bin, size_bin)
 
     results = []
-
-    for label, flow in sub_flows.items():
-        if not flow or len(flow) < 2:
-            raise ValueError(f"Flow {label} must contain at least two packets to analyze inter-packet times.")
-
-        timestamps = [packet[0] for packet in flow]
-        packet_sizes = [packet[1] for packet in flow]
-
-        inter_packet_times = [
-            timestamps[i + 1] - timestamps[i]
-            for i in range(len(timestamps) - 1)
-        ]
-
-        inter_packet_distribution = generate_distribution(inter_packet_times, time_bin)
-        size_distribution = generate_distribution(packet_sizes, size_bin)
-
-        results.append({
-            "label": label,
-            "type": "distribution",
-            "inter-packet-times": inter_packet_distribution,
-            "packet-sizes": size_distribution
-        })
+    for code, label in enumerate(labels):
+        if code in flows:
+            results.append(flow_distribution(label, flows[code]))
 
     with open(output_file, "w") as json_file:
         json.dump({"sub-flows": results}, json_file, indent=4)
@@ -0,0 +1,270 @@
+from array import array
+
+TCP_FIN = 0x01
+TCP_RST = 0x04
+TCP_PSH = 0x08
+
+DEFAULT_IDLE_TIMEOUT = 300  # seconds
+# Idle flows are reclaimed every EVICTION_INTERVAL packets
+EVICTION_INTERVAL = 1 << 16
+
+NO_MESSAGE = -1
+# Start of a message that may have begun before the current chunk
+CARRY = -2
+
+
+def create_flow_table(idle_timeout=DEFAULT_IDLE_TIMEOUT, carry=False):
+    # A connection is identified by its canonical (lower endpoint, upper endpoint)
+    # key and owns one slot. Per-slot and per-direction (slot * 2 + direction)
+    # values are kept in flat arrays, evicted slots are recycled.
+    #
+    # With carry=True the table processes one chunk of a capture: the first
+    # flow of every connection starts with CARRY accumulators and the flows are
+    # logged so that stitch_chunk can join them with the previous chunks.
+    return {
+        "idle_timeout": int(idle_timeout * 1e9),
+        "slots": {},
+        "keys": [],
+        "free": [],
+        "flow_id": array("q"),
+        "lower_is_initiator": array("b"),
+        "last_seen": array("q"),
+        "start": array("q"),
+        "size": array("q"),
+        "next_flow_id": 0,
+        "packets": 0,
+        "carry_keys": set() if carry else None,
+        "flow_log": [],
+        "heads": {},
+    }
+
+
+def _new_slot(table, key):
+    free = table["free"]
+    if free:
+        slot = free.pop()
+        table["keys"][slot] = key
+    else:
+        slot = len(table["keys"])
+        table["keys"].append(key)
+        table["flow_id"].append(0)
+        table["lower_is_initiator"].append(0)
+        table["last_seen"].append(0)
+        table["start"].extend((NO_MESSAGE, NO_MESSAGE))
+        table["size"].extend((0, 0))
+    table["slots"][key] = slot
+    return slot
+
+
+def evict_idle_flows(table, now):
+    idle_timeout = table["idle_timeout"]
+    slots = table["slots"]
+    keys = table["keys"]
+    last_seen = table["last_seen"]
+    start = table["start"]
+    size = table["size"]
+    free = table["free"]
+    for slot, key in enumerate(keys):
+        if key is not None and now - last_seen[slot] > idle_timeout:
+            del slots[key]
+            keys[slot] = None
+            start[2 * slot] = start[2 * slot + 1] = NO_MESSAGE
+            size[2 * slot] = size[2 * slot + 1] = 0
+            free.append(slot)
+
+
+def process_packets(table, packets, messages):
+    # Appends (start_ns, size, flow_id, direction) to messages for every PSH
+    # delimited message completed by packets. Direction 0 goes from the
+    # endpoint that sent the first packet of the flow.
+    idle_timeout = table["idle_timeout"]
+    slots = table["slots"]
+    flow_id = table["flow_id"]
+    lower_is_initiator = table["lower_is_initiator"]
+    last_seen = table["last_seen"]
+    start = table["start"]
+    size = table["size"]
+    carry_keys = table["carry_keys"]
+    heads = table["heads"]
+    append = messages.append
+    countdown = EVICTION_INTERVAL - table["packets"] % EVICTION_INTERVAL
+
+    for timestamp, src, dst, data_len, flags in packets:
+        src_is_lower = src < dst
+        key = (src, dst) if src_is_lower else (dst, src)
+        slot = slots.get(key)
+        if slot is None or timestamp - last_seen[slot] > idle_timeout:
+            # New connection, or a connection reused after being idle
+            initial = NO_MESSAGE
+            if slot is None:
+                slot = _new_slot(table, key)
+            if carry_keys is not None:
+                if key not in carry_keys:
+                    carry_keys.add(key)
+                    initial = CARRY
+                table["flow_log"].append((key, src_is_lower, timestamp, initial == CARRY))
+            flow_id[slot] = table["next_flow_id"]
+            table["next_flow_id"] += 1
+            lower_is_initiator[slot] = src_is_lower
+            start[2 * slot] = start[2 * slot + 1] = initial
+            size[2 * slot] = size[2 * slot + 1] = 0
+        last_seen[slot] = timestamp
+
+        direction = 0 if src_is_lower == lower_is_initiator[slot] else 1
+        index = 2 * slot + direction
+        if data_len:
+            if start[index] < 0:
+                if start[index] == NO_MESSAGE:
+                    start[index] = timestamp
+                else:
+                    heads.setdefault((flow_id[slot], direction), timestamp)
+            size[index] += data_len
+        if flags & TCP_PSH and start[index] != NO_MESSAGE:
+            append((start[index], size[index], flow_id[slot], direction))
+            start[index] = NO_MESSAGE
+            size[index] = 0
+        if flags & TCP_RST:
+            # Aborted connection: its unfinished messages never complete
+            start[2 * slot] = start[2 * slot + 1] = NO_MESSAGE
+            size[2 * slot] = size[2 * slot + 1] = 0
+        elif flags & TCP_FIN:
+            # The endpoint sends nothing more, its unfinished message never completes
+            start[index] = NO_MESSAGE
+            size[index] = 0
+
+        countdown -= 1
+        if countdown == 0:
+            evict_idle_flows(table, timestamp)
+            countdown = EVICTION_INTERVAL
+
+    table["packets"] += len(packets)
+
+
+def open_message_start(table):
+    # Start of the earliest message still being accumulated, None if there is none
+    starts = [start for start in table["start"] if start >= 0]
+    return min(starts) if starts else None
+
+
+def save_flow_table(table):
+    # JSON serialisable copy of a (non carry) table
+    return {
+        "idle_timeout": table["idle_timeout"],
+        "keys": [None if key is None else [key[0].hex(), key[1].hex()] for key in table["keys"]],
+        "free": table["free"],
+        "flow_id": table["flow_id"].tolist(),
+        "lower_is_initiator": table["lower_is_initiator"].tolist(),
+        "last_seen": table["last_seen"].tolist(),
+        "start": table["start"].tolist(),
+        "size": table["size"].tolist(),
+        "next_flow_id": table["next_flow_id"],
+        "packets": table["packets"],
+    }
+
+
+def load_flow_table(data):
+    table = create_flow_table()
+    table["idle_timeout"] = data["idle_timeout"]
+    table["keys"] = [None if key is None else (bytes.fromhex(key[0]), bytes.fromhex(key[1])) for key in data["keys"]]
+    table["slots"] = {key: slot for slot, key in enumerate(table["keys"]) if key is not None}
+    table["free"] = data["free"]
+    for name, typecode in (("flow_id", "q"), ("lower_is_initiator", "b"), ("last_seen", "q"), ("start", "q"), ("size", "q")):
+        table[name] = array(typecode, data[name])
+    table["next_flow_id"] = data["next_flow_id"]
+    table["packets"] = data["packets"]
+    return table
+
+
+def chunk_summary(table):
+    # State of a carry table at the end of its chunk, see stitch_chunk
+    last_flows = {}
+    for slot, key in enumerate(table["keys"]):
+        if key is not None:
+            last_flows[key] = (
+                table["flow_id"][slot],
+                table["last_seen"][slot],
+                [(table["start"][2 * slot + d], table["size"][2 * slot + d]) for d in (0, 1)],
+            )
+    return {
+        "flow_log": table["flow_log"],
+        "heads": table["heads"],
+        "last_flows": last_flows,
+    }
+
+
+def create_stitch_state(idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    return {
+        "idle_timeout": int(idle_timeout * 1e9),
+        "flows": {},
+        "next_flow_id": 0,
+    }
+
+
+def _resolve_carry(carried, head, size):
+    # Message made of the bytes carried from previous chunks and the bytes
+    # accumulated since the beginning of the current chunk
+    if carried is not None:
+        return carried[0], carried[1] + size
+    if head is not None:
+        return head, size
+    return None
+
+
+def stitch_chunk(state, messages, summary, output):
+    # Joins the messages of a chunk processed with a carry table to the
+    # previous chunks and appends them to output with global flow ids, as
+    # process_packets would have on the whole capture.
+    idle_timeout = state["idle_timeout"]
+    flows = state["flows"]
+    heads = summary["heads"]
+
+    mapping = []
+    for key, src_is_lower, first_seen, is_first in summary["flow_log"]:
+        previous = flows.get(key) if is_first else None
+        if previous is not None and first_seen - previous["last_seen"] <= idle_timeout:
+            global_id = previous["flow_id"]
+            flip = previous["lower_is_initiator"] != src_is_lower
+            carried = previous["tails"]
+        else:
+            global_id = state["next_flow_id"]
+            state["next_flow_id"] += 1
+            flip = False
+            carried = [None, None]
+            flows[key] = {"lower_is_initiator": src_is_lower}
+        flows[key]["flow_id"] = global_id
+        mapping.append((global_id, flip, carried))
+
+    append = output.append
+    for start, size, local_id, direction in messages:
+        global_id, flip, carried = mapping[local_id]
+        global_direction = direction ^ flip
+        if start == CARRY:
+            message = _resolve_carry(carried[global_direction], heads.get((local_id, direction)), size)
+            carried[global_direction] = None
+            if message is None:
+                continue
+            start, size = message
+        append((start, size, global_id, global_direction))
+
+    for key, _, _, is_first in summary["flow_log"]:
+        if is_first and key not in summary["last_flows"]:
+            # Evicted while idle, a later packet opens a new flow
+            flows.pop(key, None)
+    for key, (local_id, last_seen, tails) in summary["last_flows"].items():
+        global_id, flip, carried = mapping[local_id]
+        global_tails = [None, None]
+        for direction, (start, size) in enumerate(tails):
+            global_direction = direction ^ flip
+            if start == CARRY:
+                global_tails[global_direction] = _resolve_carry(
+                    carried[global_direction], heads.get((local_id, direction)), size)
+            elif start != NO_MESSAGE:
+                global_tails[global_direction] = (start, size)
+        flow = flows[key]
+        flow["last_seen"] = last_seen
+        flow["tails"] = global_tails
+
+    if summary["last_flows"]:
+        now = max(last_seen for _, last_seen, _ in summary["last_flows"].values())
+        for key in [key for key, flow in flows.items() if now - flow["last_seen"] > idle_timeout]:
+            del flows[key]
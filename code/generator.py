@@ -3,6 +3,7 @@ import json
 import random
 import numpy as np
 import argparse
+import trace_file
 
 def generate_packet(timestamp, size, label, shared_list, lock):
     with lock:
@@ -128,11 +129,13 @@ def lauch(json_input, duration, ps_generator, ipt_generator, csv_output):
         #adjust_negative_times(shared_list)
         #shared_list.sort(key=lambda packet: packet[0])
 
-        with open(csv_output, mode='w', newline='', encoding='utf-8') as csv_file:
-            csv_file.write("Time,Size,Label\n")
-            for packet in shared_list:
-                csv_file.write(f"{packet[0]},{packet[1]},{packet[2]}\n")
-            print(f'Packets generated in {csv_output}.')
+        trace = {
+            "time": np.round(np.array([packet[0] for packet in shared_list], dtype=np.float64) * trace_file.NS_PER_SECOND).astype(np.int64),
+            "size": np.array([packet[1] for packet in shared_list], dtype=np.int64),
+        }
+        trace["label"], trace["labels"] = trace_file.encode_labels([packet[2] for packet in shared_list])
+        trace_file.save_trace(csv_output, trace)
+        print(f'Packets generated in {csv_output}.')
     else:
         raise ValueError("Missing generators list in JSON configuration file.")
 
@@ -0,0 +1,136 @@
+import numpy as np
+
+# Weighted EM for 1-D Gaussian mixtures. Samples are given as distinct values
+# with their counts, so the cost of a fit depends on the number of distinct
+# packet sizes and not on the number of messages.
+#
+# A model is a dict of NumPy arrays {"means", "variances", "weights"}.
+
+MAX_ITER = 100
+TOL = 1e-3
+REG_COVAR = 1e-6
+KMEANS_ITER = 100
+
+
+def unique_counts(values):
+    # (distinct values as float64, counts, inverse) of an array of samples
+    values, inverse, counts = np.unique(np.asarray(values).ravel(), return_inverse=True, return_counts=True)
+    return values.astype(np.float64), counts.astype(np.float64), inverse.ravel()
+
+
+def _weighted_quantiles(values, weights, quantiles):
+    cumulative = np.cumsum(weights)
+    return values[np.minimum(np.searchsorted(cumulative, quantiles * cumulative[-1]), len(values) - 1)]
+
+
+def _initial_labels(values, weights, n_components):
+    # Weighted k-means started from the weighted quantiles. values are sorted,
+    # so every cluster is a contiguous range split at the midpoints of the centers.
+    centers = _weighted_quantiles(values, weights, (np.arange(n_components) + 0.5) / n_components)
+    for _ in range(KMEANS_ITER):
+        labels = np.searchsorted((centers[1:] + centers[:-1]) / 2, values)
+        mass = np.bincount(labels, weights=weights, minlength=n_components)
+        sums = np.bincount(labels, weights=weights * values, minlength=n_components)
+        new_centers = np.where(mass > 0, sums / np.maximum(mass, 1e-300), centers)
+        new_centers.sort()
+        if np.array_equal(new_centers, centers):
+            break
+        centers = new_centers
+    return np.searchsorted((centers[1:] + centers[:-1]) / 2, values)
+
+
+def _estimate_parameters(values, weights, resp, reg_covar):
+    nk = resp.T @ weights + 10 * np.finfo(np.float64).eps
+    means = (resp.T @ (weights * values)) / nk
+    variances = (resp.T @ (weights * values ** 2)) / nk - means ** 2
+    return {
+        "means": means,
+        "variances": np.maximum(variances, 0) + reg_covar,
+        "weights": nk / nk.sum(),
+    }
+
+
+def _weighted_log_prob(model, values):
+    values = np.asarray(values, dtype=np.float64).reshape(-1, 1)
+    means = model["means"]
+    variances = model["variances"]
+    return (np.log(model["weights"]) - 0.5 * (np.log(2 * np.pi * variances) + (values - means) ** 2 / variances))
+
+
+def _log_sum_exp(log_prob):
+    top = log_prob.max(axis=1)
+    return top + np.log(np.exp(log_prob - top[:, None]).sum(axis=1))
+
+
+def score_samples(model, values):
+    # Log density of every value under the mixture
+    return _log_sum_exp(_weighted_log_prob(model, values))
+
+
+def predict(model, values):
+    return _weighted_log_prob(model, values).argmax(axis=1)
+
+
+def log_likelihood(model, values, weights):
+    return float(np.dot(weights, score_samples(model, values)))
+
+
+def n_parameters(model):
+    # Means, variances and the free mixture weights
+    return 3 * len(model["means"]) - 1
+
+
+def bic(model, values, weights):
+    return -2 * log_likelihood(model, values, weights) + n_parameters(model) * np.log(np.sum(weights))
+
+
+def split_widest(model):
+    # Model with one more component: the component with the largest variance
+    # is replaced by the two halves of its Gaussian, at the mean plus or minus
+    # sd * sqrt(2 / pi) with variance var * (1 - 2 / pi) and half the weight each
+    widest = np.argmax(model["variances"])
+    mean = model["means"][widest]
+    variance = model["variances"][widest]
+    shift = np.sqrt(variance * 2 / np.pi)
+    keep = np.arange(len(model["means"])) != widest
+    return {
+        "means": np.concatenate((model["means"][keep], [mean - shift, mean + shift])),
+        "variances": np.concatenate((model["variances"][keep], [variance * (1 - 2 / np.pi)] * 2)),
+        "weights": np.concatenate((model["weights"][keep], [model["weights"][widest] / 2] * 2)),
+    }
+
+
+def fit(values, weights, n_components, max_iter=MAX_ITER, tol=TOL, reg_covar=REG_COVAR, init=None):
+    # EM on (distinct value, count) pairs. Stops when the mean log-likelihood
+    # per sample changes by less than tol, like sklearn's GaussianMixture.
+    # init is a model to start EM from instead of the k-means initialisation.
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    n_components = min(n_components, len(values))
+    total = weights.sum()
+
+    if init is not None and len(init["means"]) == n_components:
+        model = {name: np.asarray(init[name], dtype=np.float64) for name in ("means", "variances", "weights")}
+    else:
+        resp = np.zeros((len(values), n_components))
+        resp[np.arange(len(values)), _initial_labels(values, weights, n_components)] = 1
+        model = _estimate_parameters(values, weights, resp, reg_covar)
+
+    lower_bound = -np.inf
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        log_prob = _weighted_log_prob(model, values)
+        log_norm = _log_sum_exp(log_prob)
+        resp = np.exp(log_prob - log_norm[:, None])
+        model = _estimate_parameters(values, weights, resp, reg_covar)
+        previous, lower_bound = lower_bound, np.dot(weights, log_norm) / total
+        if abs(lower_bound - previous) < tol:
+            converged = True
+            break
+
+    model["converged"] = converged
+    model["n_iter"] = n_iter
+    return model
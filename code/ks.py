@@ -1,33 +1,21 @@
 from scipy.stats import ks_2samp
-import csv
 import argparse
+import numpy as np
+import trace_file
 
 def get_sizes(csv_filename):
-    sizes = []
-    with open(csv_filename, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        
-        for row in reader:
-            size_str = row["Size"]     
-            size_val = float(size_str) 
-            sizes.append(size_val)
+    sizes = trace_file.load_trace(csv_filename)["size"].astype(float).tolist()
 
     return sizes
 
 def get_inter_times(csv_filename):
-    time_values = []
-    with open(csv_filename, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        
-        for row in reader:
-            time_str = row["Time"]     
-            time_val = float(time_str) 
-            time_values.append(time_val)
+    time_values = trace_file.load_trace(csv_filename)["time"]
     
-    inter_packet_times = [(time_values[i+1] - time_values[i]) * 1000 for i in range(len(time_values) - 1)] #in ms
+    inter_packet_times = (np.diff(time_values) / trace_file.NS_PER_MS).tolist() #in ms
     return inter_packet_times
 
 def compare_with_ks(original_csv, generated_csv):
+    # Each trace is parsed once and shared by get_sizes and get_inter_times
     original_sizes = get_sizes(original_csv)
     original_inter_times = get_inter_times(original_csv)
     generated_sizes = get_sizes(generated_csv)
@@ -7,6 +7,7 @@ import distribution
 import generator
 import ks
 import stats_comparison
+import trace_file
 
 def create_parser():
     parser = argparse.ArgumentParser(
@@ -26,7 +27,8 @@ def create_parser():
     # Input and output
     parser.add_argument(
         "--input", type=str,
-        help="Path to the input file (e.g., pcap, CSV, or JSON)."
+        help="Path to the input file (e.g., pcap, CSV, or JSON). Captures may be compressed (.gz, .xz, .zst) "
+             "and a glob pattern merges several captures in timestamp order."
     )
     parser.add_argument(
         "--output", type=str,
@@ -37,22 +39,65 @@ def create_parser():
     parser.add_argument("--clustering-algorithm", type=str, default="gmm",
                         help="Clustering algorithm to use. Options: 'gmm' (default) or 'dbscan'.")
     parser.add_argument("--sub-flow", type=str, help="Specify the sub-flow number to analyze.")
+    parser.add_argument("--stats-partial", action="store_true",
+                        help="stats: save mergeable partial statistics instead of the final ones.")
+    parser.add_argument("--stats-merge", type=str, nargs="+",
+                        help="stats: merge partial statistics files of consecutive shards of a trace, in trace order, "
+                             "instead of reading --input.")
+    parser.add_argument("--stats-separate-captures", action="store_true",
+                        help="stats: the merged shards are separate captures, the time between them is not "
+                             "an inter-packet time.")
     parser.add_argument("--time-interval", type=float, default=100, help="Time interval for distributions.")
     parser.add_argument("--size-interval", type=int, default=100, help="Size interval for distributions.")
     parser.add_argument("--bin-size", type=float, help="Bin size for distribution plots.")
     parser.add_argument("--duration", type=int, default=10, help="Packet generation duration (in seconds).")
+    parser.add_argument("--idle-timeout", type=float, default=300,
+                        help="Seconds of inactivity after which a TCP connection is considered closed (default: 300).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes for app-traffic and the GMM sweep (default: 1).")
+    parser.add_argument("--follow", action="store_true",
+                        help="app-traffic: keep reading a growing capture and append new messages to the output.")
+    parser.add_argument("--start", type=float,
+                        help="app-traffic: start of the extracted window, in seconds after the first TCP packet.")
+    parser.add_argument("--end", type=float,
+                        help="app-traffic: end of the extracted window, in seconds after the first TCP packet.")
 
     # GMM-specific arguments
     parser.add_argument("--gmm-max-components", type=int, default=10, 
                         help="Maximum number of components for the GMM clustering algorithm (default: 10).")
     parser.add_argument("--gmm-min-cluster-size", type=int, default=2, 
                         help="Minimum cluster size for the GMM clustering algorithm (default: 2).")
+    parser.add_argument("--gmm-patience", type=int,
+                        help="Stop the GMM BIC sweep after this many component counts without improvement.")
+    parser.add_argument("--gmm-engine", type=str, default="sklearn", choices=["sklearn", "weighted"],
+                        help="GMM fitter: sklearn on every message (default) or weighted EM on the distinct sizes.")
+    parser.add_argument("--gmm-iterative-merge", action="store_true",
+                        help="Merge the smallest GMM cluster into the nearest one until every cluster reaches "
+                             "--gmm-min-cluster-size.")
+    parser.add_argument("--gmm-warm-start", action="store_true",
+                        help="clustering: start every GMM candidate from the previous one with its widest "
+                             "component split in two.")
+    parser.add_argument("--gmm-bootstrap", type=int,
+                        help="clustering: instead of labelling, fit the GMM labelling on this many bootstrap "
+                             "resamples and save the stability of every cluster to --output (JSON).")
+    parser.add_argument("--fit-sample", type=int,
+                        help="clustering: fit the GMM on a stratified sample of at most this many messages, "
+                             "then label the whole trace.")
+    parser.add_argument("--save-model", type=str,
+                        help="clustering: save the fitted GMM and its merge mapping to this JSON file.")
+    parser.add_argument("--apply-model", type=str,
+                        help="clustering: label the input with a saved model instead of fitting one.")
+    parser.add_argument("--partition-labels", action="store_true",
+                        help="clustering: group the rows of the binary (.atb) output by label so that "
+                             "single sub-flow modes only read their rows.")
 
     # DBSCAN-specific arguments
     parser.add_argument("--dbscan-eps", type=int, default=100, 
                         help="The epsilon parameter for the DBSCAN clustering algorithm (default: 100).")
     parser.add_argument("--dbscan-min-samples", type=int, default=5, 
                         help="The minimum samples parameter for the DBSCAN clustering algorithm (default: 5).")
+    parser.add_argument("--dbscan-suggest-eps", action="store_true",
+                        help="Use the knee of the k-distance curve of the sizes as DBSCAN epsilon.")
 
     #generator arguments
     parser.add_argument("--ipt-generator", type=str, default="uni",
@@ -86,19 +131,35 @@ def main():
     if args.mode == "app-traffic":
         if args.output:
             app_traffic_file = args.output
-        app_traffic.extract_application_traffic(args.input, app_traffic_file)
+        app_traffic.extract_application_traffic(
+            args.input, app_traffic_file, args.idle_timeout, args.workers, args.follow, args.start, args.end)
 
     elif args.mode == "clustering":
         if args.output:
             labelled_data_file = args.output
         if args.input:
             app_traffic_file = args.input
-        if args.clustering_algorithm == "gmm":
+        if args.gmm_bootstrap is not None:
+            clustering.gmm_stability(
+                app_traffic_file, labelled_data_file, args.gmm_max_components, args.gmm_min_cluster_size,
+                args.gmm_bootstrap, args.workers, args.gmm_patience, args.gmm_engine, args.gmm_iterative_merge,
+                args.gmm_warm_start)
+        elif args.apply_model:
+            clustering.apply_clustering_model(
+                app_traffic_file, labelled_data_file, args.apply_model, args.partition_labels)
+        elif args.clustering_algorithm == "gmm":
             clustering.apply_gmm_clustering(
-                app_traffic_file, labelled_data_file, args.gmm_max_components, args.gmm_min_cluster_size)
+                app_traffic_file, labelled_data_file, args.gmm_max_components, args.gmm_min_cluster_size,
+                args.partition_labels, args.workers, args.gmm_patience, args.gmm_engine,
+                args.gmm_iterative_merge, args.save_model, args.fit_sample,
+                args.gmm_warm_start)
         elif args.clustering_algorithm == "dbscan":
+            eps = args.dbscan_eps
+            if args.dbscan_suggest_eps:
+                eps = clustering.suggest_eps(trace_file.load_trace(app_traffic_file)["size"], args.dbscan_min_samples)
+                print(f"Suggested epsilon : {eps}")
             clustering.apply_dbscan_clustering(
-                app_traffic_file, labelled_data_file, args.dbscan_eps, args.dbscan_min_samples)
+                app_traffic_file, labelled_data_file, eps, args.dbscan_min_samples, args.partition_labels)
 
     elif args.mode == "generate":
         if args.output:
@@ -110,10 +171,12 @@ def main():
             stats_file = args.output
         if args.input:
             labelled_data_file = args.input
-        if args.sub_flow:
-            stats.process_sub_flow(labelled_data_file, stats_file, args.sub_flow)
+        if args.stats_merge:
+            stats.merge_statistics(args.stats_merge, stats_file, args.stats_partial, not args.stats_separate_captures)
+        elif args.sub_flow:
+            stats.process_sub_flow(labelled_data_file, stats_file, args.sub_flow, args.stats_partial)
         else:
-            stats.process_sub_flows(labelled_data_file, stats_file)
+            stats.process_sub_flows(labelled_data_file, stats_file, args.stats_partial)
 
     elif args.mode == "distributions":
         if args.output:
@@ -122,7 +185,7 @@ def main():
             labelled_data_file = args.input
         if args.sub_flow:
             distribution.sub_flow_distribution(
-                labelled_data_file, args.sub_flow, dist_file, args.time_interval, args.size_interval)
+                labelled_data_file, dist_file, args.sub_flow, args.time_interval, args.size_interval)
         else:
             distribution.sub_flows_distribution(
                 labelled_data_file, dist_file, args.time_interval, args.size_interval)
@@ -1,33 +1,22 @@
-import csv
 from collections import defaultdict
 import matplotlib.pyplot as plt
 from scipy.signal import correlate
 import numpy as np
 import argparse
+import trace_file
 
 def get_traffic(csv_file_path):
-    traffic = []
-    with open(csv_file_path, mode='r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            time = float(row['Time'])
-            size = int(row['Size'])
-
-            traffic.append((time, size))
+    trace = trace_file.load_trace(csv_file_path)
+    traffic = list(zip(trace["time"].tolist(), trace["size"].tolist()))
     traffic = sorted(traffic, key=lambda x: x[0])
     return traffic
 
 def get_sub_flows_traffic(csv_file_path):
     sub_flows_dict = defaultdict(list)
 
-    with open(csv_file_path, mode='r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            time = float(row['Time'])
-            size = int(row['Size'])
-            label = row['Label']
-
-            sub_flows_dict[label].append((time, size))
+    trace = trace_file.load_trace(csv_file_path)
+    for label, time, size in zip(trace_file.label_values(trace).tolist(), trace["time"].tolist(), trace["size"].tolist()):
+        sub_flows_dict[label].append((time, size))
 
     sub_flows = []
     for label in sorted(sub_flows_dict.keys(), key=lambda x: int(x)):
@@ -41,8 +30,9 @@ def packet_per_second(data, sampling_interval):
 
     data = sorted(data, key=lambda x: x[0])
     
+    # ns timestamps to seconds since the first message
     start_time = data[0][0]
-    data = [(t - start_time, size) for t, size in data]
+    data = [((t - start_time) / trace_file.NS_PER_SECOND, size) for t, size in data]
     
     duration = data[-1][0]
     time_points = np.arange(0, duration + sampling_interval, sampling_interval)
@@ -168,13 +158,13 @@ def main():
         "--original", 
         type=str, 
         required=True,
-        help="Original trafic file (csv)."
+        help="Original trafic file (CSV or binary trace)."
     )
     parser.add_argument(
         "--generated", 
         type=str, 
         required=True,
-        help="Generated trafic file (csv)."
+        help="Generated trafic file (CSV or binary trace)."
     )
     parser.add_argument(
         "--interval", type=float, default=1,
@@ -0,0 +1,107 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import pcap_reader
+
+INDEX_SUFFIX = ".idx"
+INDEX_INTERVAL = 1.0  # seconds of capture between two index entries
+
+
+def _index_records(buf, state, pos, interval_ns):
+    # Hops over the record headers and keeps (timestamp_ns, offset) entries
+    end = len(buf)
+    entries = []
+    next_mark = None
+    seekable = True
+    if state["format"] == "pcap":
+        record_header = struct.Struct(state["endian"] + "IIII").unpack_from
+        ts_scale = state["ts_scale"]
+        while pos + 16 <= end:
+            ts_sec, ts_frac, caplen, _ = record_header(buf, pos)
+            timestamp = ts_sec * 1000000000 + ts_frac * ts_scale
+            if next_mark is None or timestamp >= next_mark:
+                entries.append((timestamp, pos))
+                next_mark = timestamp + interval_ns
+            pos += 16 + caplen
+    else:
+        block_header = struct.Struct(state["endian"] + "III").unpack_from
+        interfaces = state["interfaces"]
+        while pos + 20 <= end:
+            block_type, block_len, interface_id = block_header(buf, pos)
+            if block_len < 12:
+                break
+            if block_type == pcap_reader.PCAPNG_EPB:
+                ts_high, ts_low = struct.unpack_from(state["endian"] + "II", buf, pos + 12)
+                _, mul, div = interfaces[interface_id]
+                timestamp = (ts_high << 32 | ts_low) * mul // div
+                if next_mark is None or timestamp >= next_mark:
+                    entries.append((timestamp, pos))
+                    next_mark = timestamp + interval_ns
+            elif block_type in (pcap_reader.PCAPNG_SHB, pcap_reader.PCAPNG_IDB):
+                # Offsets after this block need a parser state the index does not keep
+                seekable = False
+                break
+            pos += block_len
+    return entries, seekable
+
+
+def build_index(input_pcap, interval=INDEX_INTERVAL):
+    with open(input_pcap, "rb") as f:
+        stat = os.fstat(f.fileno())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            state, pos = pcap_reader.parse_header(buf)
+            if state["format"] == "pcapng":
+                pos = pcap_reader.skip_pcapng_preamble(buf, pos, state)
+            # Time origin of the extracted messages: the first TCP packet
+            first_timestamp = None
+            scan = pos
+            while first_timestamp is None and scan < len(buf):
+                packets, new_pos = pcap_reader.parse_packets(buf, scan, len(buf), dict(state), max_packets=1)
+                if packets:
+                    first_timestamp = packets[0][0]
+                if new_pos == scan:
+                    break
+                scan = new_pos
+            entries, seekable = _index_records(buf, state, pos, int(interval * 1e9))
+
+    index = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "interval": interval,
+        "state": state,
+        "first_timestamp": first_timestamp,
+        "seekable": seekable,
+        "entries": entries,
+    }
+    try:
+        with open(input_pcap + INDEX_SUFFIX, "w") as f:
+            json.dump(index, f)
+    except OSError as e:
+        # Read-only archive: the index is only used by this run
+        print(f"Could not save the index of {input_pcap} ({e.strerror}), using it in memory.")
+    return index
+
+
+def load_index(input_pcap, interval=INDEX_INTERVAL):
+    # Reads the sidecar index of a capture, (re)building it when it is missing or stale
+    index_file = input_pcap + INDEX_SUFFIX
+    stat = os.stat(input_pcap)
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+            return index
+    print(f"Indexing {input_pcap}")
+    return build_index(input_pcap, interval)
+
+
+def seek_offset(index, timestamp):
+    # Offset of a record preceding every record at or after timestamp. The
+    # entry before the matching one is used to tolerate slightly unordered captures.
+    entries = index["entries"]
+    position = bisect.bisect_right([entry[0] for entry in entries], timestamp) - 2
+    if position < 0:
+        return entries[0][1] if entries else None
+    return entries[position][1]
@@ -0,0 +1,507 @@
+import glob
+import gzip
+import heapq
+import lzma
+import mmap
+import os
+import queue
+import struct
+import threading
+from itertools import islice
+from operator import itemgetter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_EPB = 0x00000006
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+IPPROTO_TCP = 6
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+
+# Number of packets decoded per call, bounds the size of the returned lists
+BATCH_SIZE = 65536
+
+# Compressed captures are decoded in blocks of STREAM_BLOCK_SIZE bytes by a
+# background thread reading up to READ_AHEAD_BLOCKS blocks ahead of the parser
+STREAM_BLOCK_SIZE = 4 << 20
+READ_AHEAD_BLOCKS = 4
+COMPRESSION_MAGICS = {
+    b"\x1f\x8b": "gzip",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+# Splitting a capture: number of consecutive records that must be consistent
+# to accept a record boundary, and how far to look for it
+RESYNC_RECORDS = 8
+RESYNC_WINDOW = 1 << 22
+MAX_RECORD_LEN = 1 << 18
+MAX_RECORD_GAP = 3600  # seconds between two consecutive pcap records
+PCAPNG_BLOCK_TYPES = (PCAPNG_SHB, PCAPNG_IDB, PCAPNG_PB, 3, 4, 5, PCAPNG_EPB, 0x0A, 0x0BAD, 0x40000BAD)
+
+_u16 = struct.Struct("!H").unpack_from
+
+
+def decode_tcp(linktype, buf, off, caplen):
+    # Returns (source endpoint, destination endpoint, tcp payload length, tcp flags)
+    # or None if the frame is not TCP. Endpoints are the raw address + port bytes.
+    captured_end = off + caplen
+    if linktype == LINKTYPE_ETHERNET:
+        if caplen < 14:
+            return None
+        ethertype = _u16(buf, off + 12)[0]
+        l3 = off + 14
+        while ethertype in ETHERTYPE_VLAN and l3 + 4 <= captured_end:
+            ethertype = _u16(buf, l3 + 2)[0]
+            l3 += 4
+        version = 4 if ethertype == ETHERTYPE_IPV4 else 6 if ethertype == ETHERTYPE_IPV6 else 0
+    elif linktype == LINKTYPE_RAW or linktype == LINKTYPE_IPV4 or linktype == LINKTYPE_IPV6:
+        if caplen < 1:
+            return None
+        l3 = off
+        version = buf[l3] >> 4
+    elif linktype == LINKTYPE_LINUX_SLL or linktype == LINKTYPE_LINUX_SLL2:
+        if linktype == LINKTYPE_LINUX_SLL:
+            header_len, protocol_offset = 16, 14
+        else:
+            header_len, protocol_offset = 20, 0
+        if caplen < header_len:
+            return None
+        ethertype = _u16(buf, off + protocol_offset)[0]
+        l3 = off + header_len
+        version = 4 if ethertype == ETHERTYPE_IPV4 else 6 if ethertype == ETHERTYPE_IPV6 else 0
+    elif linktype == LINKTYPE_NULL:
+        if caplen < 5:
+            return None
+        l3 = off + 4
+        version = buf[l3] >> 4
+    else:
+        return None
+
+    if version == 4:
+        if l3 + 20 > captured_end:
+            return None
+        ihl = (buf[l3] & 0x0F) * 4
+        if buf[l3 + 9] != IPPROTO_TCP or _u16(buf, l3 + 6)[0] & 0x1FFF:
+            return None
+        ip_len = _u16(buf, l3 + 2)[0]
+        if ip_len == 0:
+            # TSO captures report a null total length
+            ip_len = captured_end - l3
+        l4 = l3 + ihl
+        l4_len = ip_len - ihl
+        src, dst = l3 + 12, l3 + 16
+        addr_len = 4
+    elif version == 6:
+        if l3 + 40 > captured_end:
+            return None
+        next_header = buf[l3 + 6]
+        l4_len = _u16(buf, l3 + 4)[0]
+        l4 = l3 + 40
+        src, dst = l3 + 8, l3 + 24
+        addr_len = 16
+        while next_header != IPPROTO_TCP:
+            if l4 + 8 > captured_end:
+                return None
+            if next_header in IPV6_EXTENSION_HEADERS:
+                ext_len = (buf[l4 + 1] + 1) * 8
+            elif next_header == IPV6_FRAGMENT_HEADER:
+                if _u16(buf, l4 + 2)[0] & 0xFFF8:
+                    return None
+                ext_len = 8
+            else:
+                return None
+            next_header = buf[l4]
+            l4 += ext_len
+            l4_len -= ext_len
+    else:
+        return None
+
+    if l4 + 14 > captured_end:
+        return None
+    data_offset = (buf[l4 + 12] >> 4) * 4
+    flags = ((buf[l4 + 12] & 0x0F) << 8) | buf[l4 + 13]
+    data_len = l4_len - data_offset
+    if data_len < 0:
+        data_len = 0
+    return (
+        buf[src:src + addr_len] + buf[l4:l4 + 2],
+        buf[dst:dst + addr_len] + buf[l4 + 2:l4 + 4],
+        data_len,
+        flags,
+    )
+
+
+def _timestamp_scale(tsresol):
+    # (multiplier, divisor) converting pcapng timestamp units to nanoseconds
+    exponent = tsresol & 0x7F
+    if tsresol & 0x80:
+        return 10**9, 2**exponent
+    if exponent <= 9:
+        return 10**(9 - exponent), 1
+    return 1, 10**(exponent - 9)
+
+
+def _parse_idb(buf, pos, block_len, endian):
+    linktype = struct.unpack_from(endian + "H", buf, pos + 8)[0]
+    tsresol = 6
+    opt = pos + 16
+    opt_end = pos + block_len - 4
+    while opt + 4 <= opt_end:
+        code, length = struct.unpack_from(endian + "HH", buf, opt)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            tsresol = buf[opt + 4]
+        opt += 4 + (length + 3) // 4 * 4
+    return (linktype,) + _timestamp_scale(tsresol)
+
+
+def parse_header(buf):
+    # Returns (state, offset of the first record)
+    if len(buf) < 4:
+        raise ValueError("Truncated capture file.")
+    magic = buf[:4]
+    for endian in ("<", ">"):
+        value = struct.unpack_from(endian + "I", magic)[0]
+        if value in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            if len(buf) < 24:
+                raise ValueError("Truncated pcap header.")
+            snaplen, linktype = struct.unpack_from(endian + "II", buf, 16)
+            state = {
+                "format": "pcap",
+                "endian": endian,
+                "snaplen": snaplen,
+                "linktype": linktype & 0x0FFFFFFF,
+                "ts_scale": 1000 if value == PCAP_MAGIC_US else 1,
+            }
+            return state, 24
+    if struct.unpack_from("<I", magic)[0] == PCAPNG_SHB:
+        state = {"format": "pcapng", "endian": "<", "interfaces": []}
+        return state, 0
+    raise ValueError("Unknown capture format (expected pcap or pcapng).")
+
+
+def parse_packets(buf, pos, end, state, max_packets=BATCH_SIZE):
+    # Returns ([(timestamp_ns, src, dst, data_len, flags), ...], offset of the first
+    # record not consumed). Stops before a record crossing the end of the range.
+    if state["format"] == "pcap":
+        return _parse_pcap(buf, pos, end, state, max_packets)
+    return _parse_pcapng(buf, pos, end, state, max_packets)
+
+
+def _parse_pcap(buf, pos, end, state, max_packets):
+    record_header = struct.Struct(state["endian"] + "IIII").unpack_from
+    linktype = state["linktype"]
+    ts_scale = state["ts_scale"]
+    packets = []
+    append = packets.append
+    decode = decode_tcp
+
+    while len(packets) < max_packets and pos + 16 <= end:
+        ts_sec, ts_frac, caplen, _ = record_header(buf, pos)
+        data = pos + 16
+        if data + caplen > end:
+            break
+        pos = data + caplen
+        segment = decode(linktype, buf, data, caplen)
+        if segment is not None:
+            append((ts_sec * 1000000000 + ts_frac * ts_scale,) + segment)
+    return packets, pos
+
+
+def _parse_pcapng(buf, pos, end, state, max_packets):
+    endian = state["endian"]
+    block_header = struct.Struct(endian + "II").unpack_from
+    epb_header = struct.Struct(endian + "IIIII").unpack_from
+    interfaces = state["interfaces"]
+    packets = []
+    append = packets.append
+    decode = decode_tcp
+
+    while len(packets) < max_packets and pos + 12 <= end:
+        block_type, block_len = block_header(buf, pos)
+        if block_type == PCAPNG_SHB:
+            # A new section can switch the byte order and resets the interfaces
+            endian = "<" if struct.unpack_from("<I", buf, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            block_header = struct.Struct(endian + "II").unpack_from
+            epb_header = struct.Struct(endian + "IIIII").unpack_from
+            state["endian"] = endian
+            interfaces = state["interfaces"] = []
+            block_len = block_header(buf, pos)[1]
+        if block_len < 12 or pos + block_len > end:
+            break
+
+        if block_type == PCAPNG_EPB:
+            interface_id, ts_high, ts_low, caplen, _ = epb_header(buf, pos + 8)
+            linktype, mul, div = interfaces[interface_id]
+            segment = decode(linktype, buf, pos + 28, caplen)
+            if segment is not None:
+                append(((ts_high << 32 | ts_low) * mul // div,) + segment)
+        elif block_type == PCAPNG_PB:
+            interface_id = struct.unpack_from(endian + "H", buf, pos + 8)[0]
+            ts_high, ts_low, caplen = struct.unpack_from(endian + "III", buf, pos + 12)
+            linktype, mul, div = interfaces[interface_id]
+            segment = decode(linktype, buf, pos + 28, caplen)
+            if segment is not None:
+                append(((ts_high << 32 | ts_low) * mul // div,) + segment)
+        elif block_type == PCAPNG_IDB:
+            interfaces.append(_parse_idb(buf, pos, block_len, endian))
+        pos += block_len
+    return packets, pos
+
+
+def _valid_pcap_chain(buf, pos, state):
+    record_header = struct.Struct(state["endian"] + "IIII").unpack_from
+    frac_limit = 10**9 // state["ts_scale"]
+    snaplen = state["snaplen"] or MAX_RECORD_LEN
+    end = len(buf)
+    previous_sec = None
+    for _ in range(RESYNC_RECORDS):
+        if pos == end:
+            return True
+        if pos + 16 > end:
+            return False
+        ts_sec, ts_frac, caplen, orig_len = record_header(buf, pos)
+        if ts_frac >= frac_limit or caplen > snaplen or caplen > orig_len or orig_len > MAX_RECORD_LEN:
+            return False
+        if previous_sec is not None and abs(ts_sec - previous_sec) > MAX_RECORD_GAP:
+            return False
+        previous_sec = ts_sec
+        pos += 16 + caplen
+    return pos <= end
+
+
+def _valid_pcapng_chain(buf, pos, state):
+    block_header = struct.Struct(state["endian"] + "II").unpack_from
+    trailer = struct.Struct(state["endian"] + "I").unpack_from
+    end = len(buf)
+    for _ in range(RESYNC_RECORDS):
+        if pos == end:
+            return True
+        if pos + 12 > end:
+            return False
+        block_type, block_len = block_header(buf, pos)
+        if block_type not in PCAPNG_BLOCK_TYPES or block_len < 12 or block_len % 4 or block_len > MAX_RECORD_LEN:
+            return False
+        if pos + block_len > end or trailer(buf, pos + block_len - 4)[0] != block_len:
+            return False
+        pos += block_len
+    return True
+
+
+def _find_record(buf, offset, state):
+    # First record boundary at or after offset, None if none can be found
+    if state["format"] == "pcap":
+        valid, step = _valid_pcap_chain, 1
+    else:
+        valid, step = _valid_pcapng_chain, 4
+        offset += -offset % 4
+    limit = min(len(buf), offset + RESYNC_WINDOW)
+    for pos in range(offset, limit, step):
+        if valid(buf, pos, state):
+            return pos
+    return None
+
+
+def skip_pcapng_preamble(buf, pos, state):
+    # Reads the section and interface blocks preceding the first packet
+    end = len(buf)
+    while pos + 12 <= end:
+        block_type, block_len = struct.unpack_from(state["endian"] + "II", buf, pos)
+        if block_type == PCAPNG_SHB:
+            endian = "<" if struct.unpack_from("<I", buf, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            block_len = struct.unpack_from(endian + "I", buf, pos + 4)[0]
+        elif block_type != PCAPNG_IDB:
+            break
+        _, new_pos = parse_packets(buf, pos, pos + block_len, state)
+        if new_pos == pos:
+            break
+        pos = new_pos
+    return pos
+
+
+def split_capture(buf, chunk_size):
+    # Returns (state, [(start, end), ...]) with record aligned byte ranges of
+    # about chunk_size bytes covering all the packet records of the capture
+    state, pos = parse_header(buf)
+    if state["format"] == "pcapng":
+        pos = skip_pcapng_preamble(buf, pos, state)
+    end = len(buf)
+    boundaries = [pos]
+    offset = pos + chunk_size
+    while offset < end:
+        aligned = _find_record(buf, offset, state)
+        if aligned is None:
+            break
+        if aligned > boundaries[-1]:
+            boundaries.append(aligned)
+        offset = aligned + chunk_size
+    if boundaries[-1] < end:
+        boundaries.append(end)
+    return state, list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def detect_compression(input_pcap):
+    with open(input_pcap, "rb") as f:
+        magic = f.read(6)
+    for prefix, compression in COMPRESSION_MAGICS.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def open_decompressed(input_pcap, compression):
+    if compression == "gzip":
+        return gzip.open(input_pcap, "rb")
+    if compression == "xz":
+        return lzma.open(input_pcap, "rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("Reading .zst captures requires the zstandard package.")
+        return zstandard.ZstdDecompressor().stream_reader(open(input_pcap, "rb"), closefd=True)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def read_ahead(stream, block_size=STREAM_BLOCK_SIZE, depth=READ_AHEAD_BLOCKS):
+    # Yields the blocks of stream, read (and decompressed) by a background thread
+    blocks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def reader():
+        try:
+            while not stop.is_set():
+                block = stream.read(block_size)
+                put(block)
+                if not block:
+                    return
+        except Exception as error:
+            put(error)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                return
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _read_stream_batches(stream):
+    state = None
+    buf = b""
+    pos = 0
+    for block in read_ahead(stream):
+        buf = buf[pos:] + block
+        pos = 0
+        if state is None:
+            if len(buf) < 24:
+                continue
+            state, pos = parse_header(buf)
+        while True:
+            packets, new_pos = parse_packets(buf, pos, len(buf), state)
+            if packets:
+                yield packets
+            if new_pos == pos:
+                break
+            pos = new_pos
+    if state is None:
+        parse_header(buf)
+
+
+def _read_mmap_batches(f, state=None, pos=None):
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if state is None:
+            state, pos = parse_header(buf)
+        end = len(buf)
+        while pos < end:
+            packets, new_pos = parse_packets(buf, pos, end, state)
+            if packets:
+                yield packets
+            if new_pos == pos:
+                # Truncated last record
+                break
+            pos = new_pos
+
+
+def read_tcp_batches(input_pcap, state=None, offset=None):
+    # Yields lists of (timestamp_ns, src, dst, data_len, flags) records, from
+    # the beginning of the capture or from a record offset read with state
+    compression = detect_compression(input_pcap)
+    if compression is not None:
+        if offset is not None:
+            raise ValueError("Compressed captures cannot be read from an offset.")
+        with open_decompressed(input_pcap, compression) as stream:
+            yield from _read_stream_batches(stream)
+        return
+    with open(input_pcap, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"Empty capture file: {input_pcap}")
+        yield from _read_mmap_batches(f, state, offset)
+
+
+def expand_inputs(inputs):
+    # Paths matching a capture path, glob pattern or list of them
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    paths = []
+    for pattern in inputs:
+        if any(char in pattern for char in "*?["):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError(f"No capture matches {pattern}")
+            paths.extend(matches)
+        else:
+            paths.append(pattern)
+    return paths
+
+
+def read_merged_tcp_batches(input_pcaps, batch_size=BATCH_SIZE):
+    # Yields the TCP records of several captures in timestamp order. Only the
+    # current batch of every capture is held in memory.
+    streams = [
+        (packet for packets in read_tcp_batches(input_pcap) for packet in packets)
+        for input_pcap in input_pcaps
+    ]
+    merged = heapq.merge(*streams, key=itemgetter(0))
+    while True:
+        packets = list(islice(merged, batch_size))
+        if not packets:
+            return
+        yield packets
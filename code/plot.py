@@ -1,21 +1,17 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import sub_flows as sf
-import csv
+import trace_file
 
 def plot_flow_throughput(input_file, flow_num):
-    sub_flows = sf.create_sub_flows(input_file)
-
-    if flow_num not in sub_flows:
-        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {list(sub_flows.keys())}")
-
-    flow = sub_flows[flow_num]
+    flow = sf.create_sub_flow(input_file, flow_num)
 
     if not flow or len(flow) < 2:
         raise ValueError(f"Flow {flow_num} must contain at least two packets to calculate throughput.")
 
     flow.sort(key=lambda x: x[0])
 
-    timestamps = [packet[0] for packet in flow]
+    timestamps = [packet[0] / trace_file.NS_PER_SECOND for packet in flow]
     sizes = [packet[1] for packet in flow]
 
     duration = timestamps[-1] - timestamps[0]
@@ -46,13 +42,9 @@ def plot_flow_throughput(input_file, flow_num):
 
 
 def plot_overall_throughput(input_file):
-    timestamps = []
-    sizes = []
-    with open(input_file, mode="r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            timestamps.append(float(row["Time"]))
-            sizes.append(int(row["Size"]))
+    trace = trace_file.load_trace(input_file)
+    timestamps = (trace["time"] / trace_file.NS_PER_SECOND).tolist()
+    sizes = trace["size"].tolist()
 
     if len(timestamps) < 2:
         raise ValueError("The file must contain at least two packets to calculate throughput.")
@@ -105,19 +97,12 @@ def plot_distribution(values, bin_size, title="Distribution", xlabel="Values", y
 
 
 def plot_overall_inter_packet_times(input_file, bin_size, title="Overall Inter-Packet Times Distribution", xlabel="Inter-Packet Time (ms)", ylabel="Frequency"):
-    timestamps = []
-    with open(input_file, mode="r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            timestamps.append(float(row["Time"]) * 1000)
+    timestamps = trace_file.load_trace(input_file)["time"]
 
     if len(timestamps) < 2:
         raise ValueError("The file must contain at least two packets to calculate inter-packet times.")
 
-    inter_packet_times = [
-        timestamps[i + 1] - timestamps[i]
-        for i in range(len(timestamps) - 1)
-    ]
+    inter_packet_times = (np.diff(timestamps) / trace_file.NS_PER_MS).tolist()
 
     if not inter_packet_times:
         raise ValueError("No valid inter-packet times for the overall traffic.")
@@ -132,11 +117,7 @@ def plot_overall_inter_packet_times(input_file, bin_size, title="Overall Inter-P
 
 
 def plot_overall_packet_size(input_file, bin_size, title="Overall Packet Size Distribution", xlabel="Packet Size (Bytes)", ylabel="Frequency"):
-    sizes = []
-    with open(input_file, mode="r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            sizes.append(int(row["Size"]))
+    sizes = trace_file.load_trace(input_file)["size"].tolist()
 
     if not sizes:
         raise ValueError("The file must contain at least one packet to analyze sizes.")
@@ -151,24 +132,16 @@ def plot_overall_packet_size(input_file, bin_size, title="Overall Packet Size Di
 
 
 def plot_inter_packet_times(input_file, flow_num, bin_size, title="Inter-Packet Times Distribution", xlabel="Inter-Packet Time (ms)", ylabel="Frequency"):
-    sub_flows = sf.create_sub_flows(input_file)
-
-    if flow_num not in sub_flows:
-        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {list(sub_flows.keys())}")
-
-    flow = sub_flows[flow_num]
+    flow = sf.create_sub_flow(input_file, flow_num)
 
     if not flow or len(flow) < 2:
         raise ValueError(f"Flow {flow_num} must contain at least two packets to calculate inter-packet times.")
 
     flow.sort(key=lambda x: x[0])
 
-    timestamps = [packet[0] *1000 for packet in flow]
+    timestamps = np.array([packet[0] for packet in flow], dtype=np.int64)
 
-    inter_packet_times = [
-        timestamps[i + 1] - timestamps[i]
-        for i in range(len(timestamps) - 1)
-    ]
+    inter_packet_times = (np.diff(timestamps) / trace_file.NS_PER_MS).tolist()
 
     if not inter_packet_times:
         raise ValueError(f"No valid inter-packet times for flow {flow_num}.")
@@ -183,12 +156,7 @@ def plot_inter_packet_times(input_file, flow_num, bin_size, title="Inter-Packet
 
 
 def plot_packet_size(input_file, flow_num, bin_size, title="Packet Size Distribution", xlabel="Packet Size (Bytes)", ylabel="Frequency"):
-    sub_flows = sf.create_sub_flows(input_file)
-
-    if flow_num not in sub_flows:
-        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {list(sub_flows.keys())}")
-
-    flow = sub_flows[flow_num]
+    flow = sf.create_sub_flow(input_file, flow_num)
 
     if not flow:
         raise ValueError(f"Flow {flow_num} must contain at least one packet to analyze sizes.")
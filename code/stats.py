@@ -1,11 +1,57 @@
 import json
 import numpy as np
-import sub_flows as sf
+import trace_file
+import tdigest
 import argparse
 
+# Percentiles of the stats output, estimated from the t-digest of every series
+PERCENTILES = (50, 90, 99, 99.9)
 
-def calculate_statistics(values):
+
+def empty_accumulator():
+    # Running moments of a series of values, merged chunk by chunk: count,
+    # mean and sum of squared deviations to the mean (m2), min, max and a
+    # t-digest of the values for the percentiles
+    return {"count": 0, "mean": 0.0, "m2": 0.0, "min": None, "max": None, "digest": tdigest.create()}
+
+
+def chunk_accumulator(values):
+    values = np.asarray(values, dtype=np.float64)
     if len(values) == 0:
+        return empty_accumulator()
+    mean = float(np.mean(values))
+    return {
+        "count": len(values),
+        "mean": mean,
+        "m2": float(np.sum(np.square(values - mean))),
+        "min": float(np.min(values)),
+        "max": float(np.max(values)),
+        "digest": tdigest.from_values(values),
+    }
+
+
+def merge_accumulators(first, second):
+    # Chan et al. pairwise update: exact for the count, min and max, and as
+    # stable as a single two-pass computation for the mean and m2. The
+    # digests are merged within their bounded size.
+    if second["count"] == 0:
+        return dict(first)
+    if first["count"] == 0:
+        return dict(second)
+    count = first["count"] + second["count"]
+    delta = second["mean"] - first["mean"]
+    return {
+        "count": count,
+        "mean": first["mean"] + delta * second["count"] / count,
+        "m2": first["m2"] + second["m2"] + delta * delta * first["count"] * second["count"] / count,
+        "min": min(first["min"], second["min"]),
+        "max": max(first["max"], second["max"]),
+        "digest": tdigest.merge(first["digest"], second["digest"]),
+    }
+
+
+def finish_statistics(accumulator):
+    if accumulator["count"] == 0:
         return {
             "min": None,
             "max": None,
@@ -14,87 +60,259 @@ def calculate_statistics(values):
             "stddev": None,
             "variance": None,
             "coef_of_variation": None,
+            **{f"p{percentile}": None for percentile in PERCENTILES},
         }
-    
-    mean = float(np.mean(values))
-    mean_of_squares = float(np.mean(np.square(values)))
-    variance = float(np.var(values))
-    stddev = float(np.std(values))
+
+    mean = accumulator["mean"]
+    variance = accumulator["m2"] / accumulator["count"]
+    mean_of_squares = variance + mean * mean
+    stddev = float(np.sqrt(variance))
     coef_of_variation = float(stddev / mean) if mean != 0 else None
 
     return {
-        "min": float(np.min(values)),
-        "max": float(np.max(values)),
+        "min": accumulator["min"],
+        "max": accumulator["max"],
         "mean": mean,
         "mean_of_squares": mean_of_squares,
         "stddev": stddev,
         "variance": variance,
         "coef_of_variation": coef_of_variation,
+        **{f"p{percentile}": tdigest.quantile(accumulator["digest"], percentile / 100, accumulator["min"],
+                                              accumulator["max"])
+           for percentile in PERCENTILES},
+    }
+
+
+def segment_accumulators(segments, values, n_segments):
+    # Accumulators of the values of every segment in one vectorized pass.
+    # segments are the segment indices of the values, in non-decreasing order.
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.bincount(segments, minlength=n_segments)
+    means = np.bincount(segments, weights=values, minlength=n_segments) / np.maximum(counts, 1)
+    m2 = np.bincount(segments, weights=np.square(values - means[segments]), minlength=n_segments)
+    starts = (np.cumsum(counts) - counts)[counts > 0]
+    mins = np.full(n_segments, np.nan)
+    maxs = np.full(n_segments, np.nan)
+    if len(starts):
+        mins[counts > 0] = np.minimum.reduceat(values, starts)
+        maxs[counts > 0] = np.maximum.reduceat(values, starts)
+    stops = np.cumsum(counts).tolist()
+    return [
+        {"count": count, "mean": mean, "m2": deviations, "min": low, "max": high,
+         "digest": tdigest.from_values(values[stop - count:stop])} if count else empty_accumulator()
+        for count, mean, deviations, low, high, stop in zip(counts.tolist(), means.tolist(), m2.tolist(),
+                                                             mins.tolist(), maxs.tolist(), stops)
+    ]
+
+
+def calculate_statistics(values):
+    return finish_statistics(chunk_accumulator(values))
+
+
+def empty_sub_flow():
+    # Streaming state of a sub-flow: accumulators of the sizes and of the
+    # inter-packet times, and the timestamps (ns) of the first and last
+    # messages in trace order for the IPT across chunks and shards
+    return {
+        "packet_sizes": empty_accumulator(),
+        "inter_packet_times": empty_accumulator(),
+        "first_time": None,
+        "last_time": None,
+    }
+
+
+def add_messages(sub_flow, times, sizes):
+    # Adds messages in time order, times in ns
+    if len(times) == 0:
+        return
+    if sub_flow["first_time"] is None:
+        sub_flow["first_time"] = int(times[0])
+    if sub_flow["last_time"] is not None:
+        times = np.concatenate(([sub_flow["last_time"]], times))
+    inter_packet_times = np.diff(times) / trace_file.NS_PER_MS #in ms
+    sub_flow["inter_packet_times"] = merge_accumulators(sub_flow["inter_packet_times"],
+                                                        chunk_accumulator(inter_packet_times))
+    sub_flow["packet_sizes"] = merge_accumulators(sub_flow["packet_sizes"], chunk_accumulator(sizes))
+    sub_flow["last_time"] = int(times[-1])
+
+
+def add_chunk(sub_flows, chunk):
+    # Group-by-label update of the states of sub_flows (by label) with a chunk
+    # of the trace: the label codes are stable-sorted once, so every label is
+    # a contiguous segment in time order, and the moments of all the labels
+    # come from segmented reductions. New labels are added in order of first appearance.
+    order = np.argsort(chunk["label"], kind="stable")
+    codes = chunk["label"][order]
+    times = chunk["time"][order]
+    if len(codes) == 0:
+        return
+    starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+    segments = np.cumsum(np.concatenate(([0], codes[1:] != codes[:-1])))
+    labels = [chunk["labels"][code] for code in codes[starts].tolist()]
+    states = [sub_flows.get(label) for label in labels]
+
+    # Inter-packet times: the previous message of a segment start is the last
+    # one of the label in the previous chunks, if any
+    previous = np.empty_like(times)
+    previous[1:] = times[:-1]
+    has_previous = np.ones(len(times), dtype=bool)
+    for start, state in zip(starts.tolist(), states):
+        if state is None or state["last_time"] is None:
+            has_previous[start] = False
+        else:
+            previous[start] = state["last_time"]
+    inter_packet_times = (times - previous)[has_previous] / trace_file.NS_PER_MS #in ms
+
+    size_accumulators = segment_accumulators(segments, chunk["size"][order], len(starts))
+    ipt_accumulators = segment_accumulators(segments[has_previous], inter_packet_times, len(starts))
+    first_times = times[starts].tolist()
+    last_times = times[np.append(starts[1:], len(times)) - 1].tolist()
+    for segment in np.argsort(order[starts], kind="stable").tolist():
+        state = sub_flows.setdefault(labels[segment], empty_sub_flow())
+        if state["first_time"] is None:
+            state["first_time"] = first_times[segment]
+        state["packet_sizes"] = merge_accumulators(state["packet_sizes"], size_accumulators[segment])
+        state["inter_packet_times"] = merge_accumulators(state["inter_packet_times"], ipt_accumulators[segment])
+        state["last_time"] = last_times[segment]
+
+
+def merge_sub_flows(first, second, bridge=True):
+    # Exact merge of the states of a sub-flow over two shards of messages.
+    # With bridge, second follows first in the same trace, and the time from
+    # the last message of first to the first message of second is an
+    # inter-packet time of the merged sub-flow.
+    if second["first_time"] is None:
+        return dict(first)
+    if first["first_time"] is None:
+        return dict(second)
+    inter_packet_times = first["inter_packet_times"]
+    if bridge:
+        gap = (second["first_time"] - first["last_time"]) / trace_file.NS_PER_MS #in ms
+        inter_packet_times = merge_accumulators(inter_packet_times, chunk_accumulator([gap]))
+    return {
+        "packet_sizes": merge_accumulators(first["packet_sizes"], second["packet_sizes"]),
+        "inter_packet_times": merge_accumulators(inter_packet_times, second["inter_packet_times"]),
+        "first_time": first["first_time"],
+        "last_time": second["last_time"],
     }
 
+
+def sub_flow_statistics(sub_flow):
+    if sub_flow["packet_sizes"]["count"] < 2:
+        raise ValueError("Minimum 2 packets to compute statistics")
+    return {
+        "inter_packet_times": finish_statistics(sub_flow["inter_packet_times"]),
+        "packet_sizes": finish_statistics(sub_flow["packet_sizes"]),
+    }
+
+
 def compute_packet_statistics(packet_list):
     if len(packet_list) < 2:
         raise ValueError("Minimum 2 packets to compute statistics")
 
-    timestamps = [packet[0] for packet in packet_list]
-    sizes = [packet[1] for packet in packet_list]
-
-    inter_packet_times = [(timestamps[i+1] - timestamps[i]) * 1000 for i in range(len(timestamps) - 1)] #in ms 
+    packets = np.asarray(packet_list, dtype=np.int64)
+    sub_flow = empty_sub_flow()
+    add_messages(sub_flow, packets[:, 0], packets[:, 1])
+    return sub_flow_statistics(sub_flow)
 
-    inter_packet_stats = calculate_statistics(inter_packet_times)
-    size_stats = calculate_statistics(sizes)
 
+def _stats_entry(label, statistics):
     return {
-        "inter_packet_times": inter_packet_stats,
-        "packet_sizes": size_stats,
+        "label": label,
+        "type": "stats",
+        "packet-sizes": statistics["packet_sizes"],
+        "inter-packet-times": statistics["inter_packet_times"]
     }
 
 
-def process_sub_flow(input_file, output_file, flow_num):
-    sub_flows = sf.create_sub_flows(input_file)
-    
-    if flow_num not in sub_flows:
-        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {list(sub_flows.keys())}")
-    
-    sub_flow = sub_flows[flow_num]
-    statistics = compute_packet_statistics(sub_flow)
-    
-    results = {
-        "sub-flows": [
-            {
-                "label": flow_num,
-                "type": "stats",
-                "packet-sizes": statistics["packet_sizes"],
-                "inter-packet-times": statistics["inter_packet_times"]
-            }
-        ]
+def _partial_entry(label, sub_flow):
+    return {
+        "label": label,
+        "type": "partial",
+        "first_time": sub_flow["first_time"],
+        "last_time": sub_flow["last_time"],
+        "packet-sizes": sub_flow["packet_sizes"],
+        "inter-packet-times": sub_flow["inter_packet_times"]
     }
-    
-    with open(output_file, mode="w") as json_file:
-        json.dump(results, json_file, indent=4)
-    
-    print(f"Statistics for flow {flow_num} saved in {output_file}")
 
 
-def process_sub_flows(input_file, output_file):
-    sub_flows = sf.create_sub_flows(input_file)
-    
+def save_sub_flows(output_file, sub_flows, partial=False):
+    # Final statistics of the sub-flows, or with partial their mergeable states
     results = {"sub-flows": []}
     for label, sub_flow in sub_flows.items():
-        statistics = compute_packet_statistics(sub_flow)
-        results["sub-flows"].append({
-            "label": label,
-            "type": "stats",
-            "packet-sizes": statistics["packet_sizes"],
-            "inter-packet-times": statistics["inter_packet_times"]
-        })
-    
+        if partial:
+            results["sub-flows"].append(_partial_entry(label, sub_flow))
+        else:
+            results["sub-flows"].append(_stats_entry(label, sub_flow_statistics(sub_flow)))
+
     with open(output_file, mode="w") as json_file:
         json.dump(results, json_file, indent=4)
+
+
+def load_partial(input_file):
+    with open(input_file, mode="r") as json_file:
+        results = json.load(json_file)
+    sub_flows = {}
+    for entry in results["sub-flows"]:
+        if entry.get("type") != "partial":
+            raise ValueError(f"{input_file} does not hold partial statistics, save them with --partial.")
+        sub_flows[entry["label"]] = {
+            "packet_sizes": entry["packet-sizes"],
+            "inter_packet_times": entry["inter-packet-times"],
+            "first_time": entry["first_time"],
+            "last_time": entry["last_time"],
+        }
+    return sub_flows
+
+
+def process_sub_flow(input_file, output_file, flow_num, partial=False):
+    # One streaming pass over the rows of the sub-flow, by chunks
+    sub_flow = empty_sub_flow()
+    labels = []
+    for chunk in trace_file.iter_trace_chunks(input_file, label=flow_num):
+        add_messages(sub_flow, chunk["time"], chunk["size"])
+        labels = chunk["labels"]
+    if flow_num not in labels:
+        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {labels}")
+
+    save_sub_flows(output_file, {flow_num: sub_flow}, partial)
+    
+    print(f"Statistics for flow {flow_num} saved in {output_file}")
+
+
+def process_sub_flows(input_file, output_file, partial=False):
+    # One streaming pass over the trace by chunks, sub-flows in order of first appearance
+    sub_flows = {}
+    for chunk in trace_file.iter_trace_chunks(input_file):
+        add_chunk(sub_flows, chunk)
+
+    save_sub_flows(output_file, sub_flows, partial)
     
     print(f"Statistics saved in {output_file}")
 
 
+def merge_statistics(input_files, output_file, partial=False, bridge=True):
+    # Reduces partial statistics of shards saved with partial=True, given in
+    # trace order. With bridge the shards are consecutive parts of the same
+    # trace, else they are separate captures whose messages are pooled. The
+    # result is final statistics or, with partial, a partial that can be
+    # merged again.
+    shards = {}
+    for input_file in input_files:
+        for label, sub_flow in load_partial(input_file).items():
+            shards.setdefault(label, []).append(sub_flow)
+
+    sub_flows = {}
+    for label, states in shards.items():
+        merged = empty_sub_flow()
+        for state in states:
+            merged = merge_sub_flows(merged, state, bridge)
+        sub_flows[label] = merged
+
+    save_sub_flows(output_file, sub_flows, partial)
+
+    print(f"Statistics of {len(input_files)} shards merged in {output_file}")
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -105,8 +323,7 @@ def main():
     parser.add_argument(
         "--input", 
         type=str, 
-        required=True,
-        help="Path to the input file (PCAP)."
+        help="Path to the input file (CSV or binary trace)."
     )
     parser.add_argument(
         "--output", 
@@ -118,11 +335,28 @@ def main():
         "--sub-flow", 
         type=str, 
         help="Specify the sub-flow number to analyze.")
+    parser.add_argument(
+        "--partial", 
+        action="store_true", 
+        help="Save mergeable partial statistics instead of the final ones.")
+    parser.add_argument(
+        "--merge", 
+        type=str, 
+        nargs="+", 
+        help="Merge partial statistics files of consecutive shards of a trace, in trace order, instead of reading --input.")
+    parser.add_argument(
+        "--separate-captures", 
+        action="store_true", 
+        help="With --merge, the shards are separate captures: the time between them is not an inter-packet time.")
     args = parser.parse_args()
 
-    if args.sub_flow:
-        process_sub_flow(args.input, args.output, args.sub_flow)
+    if args.merge:
+        merge_statistics(args.merge, args.output, args.partial, not args.separate_captures)
+    elif args.input is None:
+        parser.error("--input is required unless --merge is given")
+    elif args.sub_flow:
+        process_sub_flow(args.input, args.output, args.sub_flow, args.partial)
     else:
-        process_sub_flows(args.input, args.output)
+        process_sub_flows(args.input, args.output, args.partial)
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,13 +1,17 @@
-import csv
+import trace_file
 from collections import defaultdict
 
 def create_sub_flows(input_csv):
+    trace = trace_file.load_trace(input_csv)
     label_dict = defaultdict(list)
-    with open(input_csv, mode="r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            label = row["Label"]
-            timestamp = float(row["Time"])
-            size = int(row["Size"])
-            label_dict[label].append((timestamp, size))
+    for label, timestamp, size in zip(trace_file.label_values(trace).tolist(), trace["time"].tolist(), trace["size"].tolist()):
+        label_dict[label].append((timestamp, size))
     return label_dict
+
+def create_sub_flow(input_csv, flow_num):
+    # (timestamp, size) messages of one sub-flow, reading only its rows when
+    # the trace is partitioned by label
+    trace = trace_file.load_sub_flow(input_csv, flow_num)
+    if flow_num not in trace["labels"]:
+        raise ValueError(f"Invalid flow number: {flow_num}. Available flows: {trace['labels']}")
+    return list(zip(trace["time"].tolist(), trace["size"].tolist()))
@@ -0,0 +1,56 @@
+import numpy as np
+
+# Merging t-digest quantile sketch. A digest is a dict of JSON-ready lists
+# {"means", "weights"}: centroids sorted by mean. Centroids are merged while
+# they fit in one unit of the k2 scale function
+#     k(q) = compression / z * log(q / (1 - q)),  z = 4 * log(n / compression) + 24
+# for n values, which keeps them small near the tails, where the p99 and
+# p99.9 of heavy-tailed inter-packet times are read. The number of
+# centroids stays around compression / 2 whatever the number of values.
+
+COMPRESSION = 200
+
+
+def create():
+    return {"means": [], "weights": []}
+
+
+def _compress(means, weights, compression):
+    order = np.argsort(means, kind="stable")
+    means = means[order]
+    weights = weights[order]
+    if len(means) == 0:
+        return create()
+    total = weights.sum()
+    # Centroids of the same unit of k, taken at the middle of their weight, are merged
+    middle = (np.cumsum(weights) - weights / 2) / total
+    z = 4 * np.log(max(total / compression, 1)) + 24
+    bins = np.floor(compression / z * np.log(middle / (1 - middle)))
+    starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+    merged_weights = np.add.reduceat(weights, starts)
+    merged_means = np.add.reduceat(weights * means, starts) / merged_weights
+    return {"means": merged_means.tolist(), "weights": merged_weights.tolist()}
+
+
+def from_values(values, compression=COMPRESSION):
+    values = np.asarray(values, dtype=np.float64)
+    return _compress(values, np.ones(len(values)), compression)
+
+
+def merge(first, second, compression=COMPRESSION):
+    means = np.array(first["means"] + second["means"], dtype=np.float64)
+    weights = np.array(first["weights"] + second["weights"], dtype=np.float64)
+    return _compress(means, weights, compression)
+
+
+def quantile(digest, q, low, high):
+    # Estimated q-quantile (0 <= q <= 1), interpolating between the centroids
+    # placed at the middle of their cumulative weight. low and high are the
+    # exact minimum and maximum of the values.
+    if not digest["weights"]:
+        return None
+    weights = np.asarray(digest["weights"])
+    total = weights.sum()
+    positions = np.concatenate(([0], np.cumsum(weights) - weights / 2, [total]))
+    values = np.concatenate(([low], digest["means"], [high]))
+    return float(np.interp(q * total, positions, values))
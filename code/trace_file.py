@@ -0,0 +1,529 @@
+import csv
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+import itertools
+import json
+import os
+import struct
+import tempfile
+import warnings
+import numpy as np
+
+# Binary trace layout: magic, format version, header length, JSON header then
+# one contiguous little-endian array per column, aligned on COLUMN_ALIGNMENT
+# bytes. Times are stored as int64 nanoseconds and labels as uint16 codes into
+# the "labels" dictionary of the header.
+#
+# A label-partitioned trace stores the rows grouped by label code, each group
+# in the original order. The "partitions" list of the header gives the
+# [start, stop) rows of every label code and the "position" column the
+# original row of every stored row.
+TRACE_SUFFIX = ".atb"
+TRACE_MAGIC = b"ATATRACE"
+TRACE_VERSION = 1
+COLUMN_ALIGNMENT = 64
+
+COLUMN_DTYPES = {
+    "time": "<i8",
+    "size": "<u4",
+    "flow": "<u4",
+    "direction": "<u1",
+    "label": "<u2",
+    "position": "<u8",
+}
+# Column names in CSV traces
+CSV_COLUMNS = {
+    "time": "Time",
+    "size": "Size",
+    "flow": "Flow",
+    "direction": "Direction",
+    "label": "Label",
+}
+
+# Times are int64 nanoseconds in every stage, CSV traces hold decimal seconds
+NS_PER_SECOND = 1000000000
+NS_PER_MS = 1000000
+
+# CSV rows parsed per block by iter_trace_chunks
+CHUNK_ROWS = 1 << 20
+# Types of the numeric CSV columns, "time" is parsed by parse_times and the
+# other columns are kept as strings
+CSV_DTYPES = {
+    "size": np.int64,
+    "flow": np.int64,
+    "direction": np.int64,
+}
+
+# Loaded traces by absolute path, with the (mtime_ns, size) they were read at
+_cache = {}
+
+
+def is_trace_file(path):
+    return str(path).endswith(TRACE_SUFFIX)
+
+
+def parse_times(values):
+    # Exact conversion of decimal seconds to int64 nanoseconds. Plain decimals
+    # with up to 9 fractional digits are converted digit by digit from the
+    # UTF-32 code points of the strings, other notations (exponents, more
+    # digits, spaces) are rounded half to even with Decimal.
+    values = np.ascontiguousarray(values, dtype=str)
+    rows = len(values)
+    width = values.dtype.itemsize // 4
+    times = np.zeros(rows, dtype=np.int64)
+    if rows == 0:
+        return times
+    codes = values.view(np.uint32).reshape(rows, max(width, 1)) if width else np.zeros((rows, 1), dtype=np.uint32)
+    length = np.count_nonzero(codes, axis=1)
+    is_digit = (codes >= ord("0")) & (codes <= ord("9"))
+    is_dot = codes == ord(".")
+    dots = np.count_nonzero(is_dot, axis=1)
+    dot_pos = np.where(dots > 0, is_dot.argmax(axis=1), length)
+    signed = (codes[:, 0] == ord("-")) | (codes[:, 0] == ord("+"))
+    digits = np.count_nonzero(is_digit, axis=1)
+    plain = ((dots <= 1) & (digits > 0) & (digits == length - dots - signed)
+             & (length - dot_pos - dots <= 9) & (dot_pos - signed <= 10))
+
+    powers = 10 ** np.arange(19, dtype=np.int64)
+    for j in range(codes.shape[1]):
+        # Power of ten in nanoseconds of the j-th character
+        power = np.where(j < dot_pos, dot_pos - 1 - j + 9, 9 - (j - dot_pos))
+        digit = np.where(is_digit[:, j], codes[:, j].astype(np.int64) - ord("0"), 0)
+        times += digit * powers[np.clip(power, 0, 18)]
+    # 10 digit seconds above the int64 range wrap around
+    plain &= times >= 0
+    times[codes[:, 0] == ord("-")] *= -1
+
+    for i in np.flatnonzero(~plain).tolist():
+        try:
+            times[i] = int((Decimal(values[i]) * NS_PER_SECOND).to_integral_value(ROUND_HALF_EVEN))
+        except (InvalidOperation, OverflowError):
+            raise ValueError(f"Invalid time: {values[i]}")
+    return times
+
+
+def format_times(times):
+    # Decimal seconds of int64 nanoseconds without trailing zeros, built as
+    # UTF-32 code points like parse_times reads them
+    times = np.asarray(times, dtype=np.int64)
+    rows = len(times)
+    if rows == 0:
+        return []
+    negative = times < 0
+    whole, fraction = np.divmod(np.abs(times), NS_PER_SECOND)
+    powers = 10 ** np.arange(19, dtype=np.int64)
+    whole_digits = 1 + np.count_nonzero(whole[:, None] >= powers[1:], axis=1)
+    fraction_digits = np.full(rows, 9)
+    for k in range(1, 9):
+        fraction_digits[fraction % powers[k] == 0] = 9 - k
+
+    dot_pos = negative + whole_digits
+    codes = np.zeros((rows, int((dot_pos + fraction_digits).max()) + 1), dtype=np.uint32)
+    codes[negative, 0] = ord("-")
+    index = np.arange(rows)
+    for k in range(int(whole_digits.max())):
+        # k-th digit of the seconds from the right
+        used = whole_digits > k
+        codes[index[used], dot_pos[used] - 1 - k] = ord("0") + whole[used] // powers[k] % 10
+    codes[index, dot_pos] = ord(".")
+    for k in range(int(fraction_digits.max())):
+        used = fraction_digits > k
+        codes[index[used], dot_pos[used] + 1 + k] = ord("0") + fraction[used] // powers[8 - k] % 10
+    return codes.view(f"<U{codes.shape[1]}").ravel().tolist()
+
+
+def encode_labels(values):
+    # Returns (uint16 codes, label strings) with labels in order of first appearance
+    values = np.asarray(values).astype(str)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint16), []
+    labels, first_index, inverse = np.unique(values, return_index=True, return_inverse=True)
+    if len(labels) > np.iinfo(np.uint16).max + 1:
+        raise ValueError(f"Too many labels for a binary trace: {len(labels)}")
+    order = np.argsort(first_index)
+    rank = np.empty(len(order), dtype=np.uint16)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.ravel()], labels[order].tolist()
+
+
+def write_trace(path, columns, labels=None, partitions=None):
+    # columns maps column names of COLUMN_DTYPES to arrays of equal length,
+    # "time" in nanoseconds and "label" as codes into labels
+    rows = len(columns["time"])
+    header = {"rows": rows, "columns": {}, "labels": labels or []}
+    if partitions is not None:
+        header["partitions"] = partitions
+    arrays = []
+    offset = 0
+    for name, values in columns.items():
+        if name not in COLUMN_DTYPES:
+            raise ValueError(f"Unsupported column in a binary trace: {name}")
+        array = np.ascontiguousarray(values, dtype=COLUMN_DTYPES[name])
+        if len(array) != rows:
+            raise ValueError(f"Column {name} has {len(array)} rows instead of {rows}")
+        header["columns"][name] = {"dtype": COLUMN_DTYPES[name], "offset": offset}
+        arrays.append(array)
+        offset += -(-array.nbytes // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(TRACE_MAGIC) + 8 + len(header_bytes)) // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+    header_bytes = header_bytes.ljust(data_start - len(TRACE_MAGIC) - 8)
+    with open(path, "wb") as f:
+        f.write(TRACE_MAGIC + struct.pack("<II", TRACE_VERSION, len(header_bytes)) + header_bytes)
+        for array in arrays:
+            # Written from the buffer, spooled columns are not copied in memory
+            f.write(memoryview(array).cast("B"))
+            f.write(b"\0" * (-array.nbytes % COLUMN_ALIGNMENT))
+
+
+def read_trace(path):
+    # Returns the columns of a binary trace, in storage order, as read-only
+    # memory-mapped arrays, the label dictionary under "labels" and the
+    # label row ranges under "partitions" for a label-partitioned trace
+    with open(path, "rb") as f:
+        preamble = f.read(len(TRACE_MAGIC) + 8)
+        if preamble[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a binary trace.")
+        version, header_len = struct.unpack_from("<II", preamble, len(TRACE_MAGIC))
+        if version != TRACE_VERSION:
+            raise ValueError(f"Unsupported binary trace version: {version}")
+        header = json.loads(f.read(header_len))
+    data_start = len(TRACE_MAGIC) + 8 + header_len
+
+    trace = {}
+    rows = header["rows"]
+    for name, column in header["columns"].items():
+        if rows == 0:
+            trace[name] = np.zeros(0, dtype=column["dtype"])
+        else:
+            trace[name] = np.memmap(path, dtype=column["dtype"], mode="r",
+                                    offset=data_start + column["offset"], shape=(rows,))
+    trace["labels"] = header["labels"]
+    if "partitions" in header:
+        trace["partitions"] = header["partitions"]
+    return trace
+
+
+def partition_trace(trace):
+    # Binary columns of a load_trace shaped trace grouped by label, see
+    # write_trace. Returns (columns, partitions).
+    order = np.argsort(trace["label"], kind="stable")
+    columns = {name: np.asarray(values)[order] for name, values in trace.items() if name != "labels"}
+    columns["position"] = order
+    counts = np.bincount(trace["label"], minlength=len(trace["labels"]))
+    stops = np.cumsum(counts)
+    partitions = [[start, stop] for start, stop in zip((stops - counts).tolist(), stops.tolist())]
+    return columns, partitions
+
+
+def _original_order(trace):
+    # Rows of a label-partitioned binary trace in their original order
+    rows = np.empty(len(trace["position"]), dtype=np.int64)
+    rows[trace["position"]] = np.arange(len(rows))
+    return rows
+
+
+def _trace_rows(trace, rows):
+    # load_trace shaped columns of the given stored rows of a binary trace
+    columns = {}
+    for name, values in trace.items():
+        if name in ("labels", "partitions", "position"):
+            continue
+        columns[name] = values[rows]
+    columns["labels"] = trace["labels"]
+    return columns
+
+
+def encode_chunk_labels(values, label_codes, labels):
+    # Codes of a chunk of label strings into the labels collected so far,
+    # new labels are appended in order of first appearance
+    codes, chunk_labels = encode_labels(values)
+    mapping = np.empty(len(chunk_labels), dtype=np.uint16)
+    for code, label in enumerate(chunk_labels):
+        if label not in label_codes:
+            if len(labels) > np.iinfo(np.uint16).max:
+                raise ValueError(f"Too many labels for a binary trace: {len(labels) + 1}")
+            label_codes[label] = len(labels)
+            labels.append(label)
+        mapping[code] = label_codes[label]
+    return mapping[codes]
+
+
+def _empty_csv_chunk(columns):
+    chunk = {}
+    for name in columns:
+        if name == "label":
+            chunk[name], chunk["labels"] = encode_labels([])
+        elif name == "time":
+            chunk[name] = np.zeros(0, dtype=np.int64)
+        else:
+            chunk[name] = np.zeros(0, dtype=CSV_DTYPES.get(name, str))
+    return chunk
+
+
+def _iter_csv_chunks(path, chunk_rows):
+    with open(path, mode="r", newline="") as f:
+        fieldnames = next(csv.reader([f.readline()]), [])
+        names = {csv_name: name for name, csv_name in CSV_COLUMNS.items()}
+        columns = [names.get(fieldname, fieldname) for fieldname in fieldnames]
+        numeric = [(i, name) for i, name in enumerate(columns) if name in CSV_DTYPES]
+        numeric_dtype = [(name, CSV_DTYPES[name]) for _, name in numeric]
+        label_codes = {}
+        labels = []
+        first = True
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                if first:
+                    # Header only trace: a single empty chunk carries the columns
+                    yield _empty_csv_chunk(columns)
+                break
+            first = False
+            # Blocks are parsed by the C reader of np.loadtxt, one call for the
+            # numeric columns and one per string column
+            chunk = {}
+            if numeric:
+                values = np.loadtxt(lines, delimiter=",", quotechar='"', ndmin=1,
+                                    usecols=[i for i, _ in numeric], dtype=numeric_dtype)
+                for name in values.dtype.names:
+                    chunk[name] = np.ascontiguousarray(values[name])
+            with warnings.catch_warnings():
+                # Blank lines are skipped like in the numeric columns
+                warnings.simplefilter("ignore", UserWarning)
+                for i, name in enumerate(columns):
+                    if name in CSV_DTYPES:
+                        continue
+                    values = np.loadtxt(lines, delimiter=",", quotechar='"', ndmin=1, usecols=i, dtype=str)
+                    if name == "time":
+                        chunk[name] = parse_times(values)
+                    elif name == "label":
+                        chunk[name] = encode_chunk_labels(values, label_codes, labels)
+                        chunk["labels"] = list(labels)
+                    else:
+                        chunk[name] = values
+            yield {name: chunk[name] for name in columns + ["labels"] if name in chunk}
+
+
+def iter_trace_chunks(path, chunk_rows=CHUNK_ROWS, label=None):
+    # Yields the columns of a trace by blocks of at most chunk_rows rows, shaped
+    # like the ones of load_trace. Label codes are consistent across chunks, the
+    # "labels" list of a chunk covers every label seen up to it. A trace
+    # without rows yields a single empty chunk.
+    #
+    # With label, only the rows of that label are yielded. A label-partitioned
+    # trace then reads nothing but the rows of the label.
+    if not is_trace_file(path):
+        for chunk in _iter_csv_chunks(path, chunk_rows):
+            if label is not None:
+                keep = chunk["label"] == (chunk["labels"].index(label) if label in chunk["labels"] else -1)
+                chunk = {name: values if name == "labels" else values[keep] for name, values in chunk.items()}
+            yield chunk
+        return
+
+    trace = read_trace(path)
+    if "partitions" in trace:
+        if label is not None:
+            if label not in trace["labels"]:
+                yield _trace_rows(trace, slice(0, 0))
+                return
+            start, stop = trace["partitions"][trace["labels"].index(label)]
+            for position in range(start, stop, chunk_rows):
+                yield _trace_rows(trace, slice(position, min(position + chunk_rows, stop)))
+            return
+        rows = _original_order(trace)
+        for start in range(0, max(len(rows), 1), chunk_rows):
+            yield _trace_rows(trace, rows[start:start + chunk_rows])
+        return
+    for start in range(0, max(len(trace["time"]), 1), chunk_rows):
+        chunk = _trace_rows(trace, slice(start, start + chunk_rows))
+        if label is not None:
+            keep = chunk["label"] == (trace["labels"].index(label) if label in trace["labels"] else -1)
+            chunk = {name: values if name == "labels" else values[keep] for name, values in chunk.items()}
+        yield chunk
+
+
+def _read_csv(path):
+    chunks = list(_iter_csv_chunks(path, CHUNK_ROWS))
+    trace = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0] if name != "labels"}
+    if "labels" in chunks[-1]:
+        trace["labels"] = chunks[-1]["labels"]
+    return trace
+
+
+def _load_trace(path):
+    if not is_trace_file(path):
+        return _read_csv(path)
+    trace = read_trace(path)
+    if "partitions" in trace:
+        return _trace_rows(trace, _original_order(trace))
+    return trace
+
+
+def load_trace(path):
+    # Columns of a CSV or binary trace as NumPy arrays: "time" in int64 nanoseconds,
+    # "size", optional "flow"/"direction", and "label" codes into the
+    # "labels" list. Unknown CSV columns are kept as strings.
+    #
+    # Traces are memoized by path, mtime and size: the arrays are shared
+    # between callers and read-only, the returned dict is a copy.
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    cached = _cache.get(key)
+    if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+        trace = _load_trace(path)
+        for name, values in trace.items():
+            if isinstance(values, np.ndarray):
+                values.flags.writeable = False
+        cached = ((stat.st_mtime_ns, stat.st_size), trace)
+        _cache[key] = cached
+    return dict(cached[1])
+
+
+def load_sub_flow(path, label):
+    # Columns of the rows of one label, shaped like the ones of load_trace.
+    # Only the partition of the label is read from a label-partitioned trace.
+    if is_trace_file(path):
+        trace = read_trace(path)
+        if "partitions" in trace:
+            if label in trace["labels"]:
+                start, stop = trace["partitions"][trace["labels"].index(label)]
+            else:
+                start = stop = 0
+            return _trace_rows(trace, slice(start, stop))
+    trace = load_trace(path)
+    keep = trace["label"] == (trace["labels"].index(label) if label in trace["labels"] else -1)
+    return {name: values if name == "labels" else values[keep] for name, values in trace.items()}
+
+
+def clear_trace_cache():
+    _cache.clear()
+
+
+def label_values(trace):
+    # Label of every row as a string array
+    return np.asarray(trace["labels"], dtype=str)[trace["label"]]
+
+
+def _check_times(trace):
+    if np.asarray(trace["time"]).dtype.kind not in "iu":
+        raise ValueError("Trace times must be integer nanoseconds.")
+
+
+def _csv_values(trace, names):
+    values = []
+    for name in names:
+        if name == "label":
+            values.append(label_values(trace).tolist())
+        elif name == "time":
+            values.append(format_times(trace[name]))
+        else:
+            values.append(np.asarray(trace[name]).tolist())
+    return values
+
+
+def save_trace(path, trace, partition=False):
+    # Writes columns shaped like the ones of load_trace as CSV or binary
+    # depending on the suffix. partition groups the rows of a binary trace by label.
+    _cache.pop(os.path.abspath(path), None)
+    names = [name for name in trace if name != "labels"]
+    _check_times(trace)
+    if is_trace_file(path):
+        columns = {name: trace[name] for name in names}
+        partitions = None
+        if partition:
+            if "label" not in trace:
+                raise ValueError("Only a labelled trace can be partitioned by label.")
+            columns, partitions = partition_trace(dict(columns, labels=trace["labels"]))
+        write_trace(path, columns, trace.get("labels"), partitions)
+        return
+    if partition:
+        raise ValueError(f"Label partitioning needs a binary trace ({TRACE_SUFFIX}): {path}")
+
+    with open(path, mode="w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([CSV_COLUMNS.get(name, name) for name in names])
+        writer.writerows(zip(*_csv_values(trace, names)))
+
+
+def _spool_column(spools, name, values, directory):
+    # Appends values to the temporary file of a binary column
+    if name not in COLUMN_DTYPES:
+        raise ValueError(f"Unsupported column in a binary trace: {name}")
+    if name not in spools:
+        spools[name] = tempfile.TemporaryFile(dir=directory)
+    spools[name].write(np.ascontiguousarray(values, dtype=COLUMN_DTYPES[name]).tobytes())
+
+
+def _spooled_columns(spools, rows):
+    columns = {}
+    for name, spool in spools.items():
+        spool.flush()
+        if rows == 0:
+            columns[name] = np.zeros(0, dtype=COLUMN_DTYPES[name])
+        else:
+            columns[name] = np.memmap(spool, dtype=COLUMN_DTYPES[name], mode="r", shape=(rows,))
+    return columns
+
+
+def _partition_spooled(columns, n_labels, spools, directory):
+    # partition_trace on spooled columns: one pass over the columns per label
+    # code, by blocks of CHUNK_ROWS rows. Returns the partitions.
+    rows = len(columns["label"])
+    counts = np.zeros(n_labels, dtype=np.int64)
+    # Every column is spooled, even without rows or labels
+    for name, values in columns.items():
+        _spool_column(spools, name, values[:0], directory)
+    _spool_column(spools, "position", np.zeros(0, dtype=np.int64), directory)
+    for code in range(n_labels):
+        for start in range(0, rows, CHUNK_ROWS):
+            keep = np.flatnonzero(columns["label"][start:start + CHUNK_ROWS] == code)
+            counts[code] += len(keep)
+            for name, values in columns.items():
+                _spool_column(spools, name, values[start:start + CHUNK_ROWS][keep], directory)
+            _spool_column(spools, "position", keep + start, directory)
+    stops = np.cumsum(counts)
+    return [[start, stop] for start, stop in zip((stops - counts).tolist(), stops.tolist())]
+
+
+def save_trace_chunks(path, chunks, partition=False):
+    # save_trace for chunks shaped like the ones of iter_trace_chunks, with
+    # label codes consistent across chunks. Only one chunk is held in memory:
+    # binary columns are spooled to temporary files next to path and copied
+    # behind the header once the number of rows and the labels are known.
+    _cache.pop(os.path.abspath(path), None)
+    if not is_trace_file(path):
+        if partition:
+            raise ValueError(f"Label partitioning needs a binary trace ({TRACE_SUFFIX}): {path}")
+        with open(path, mode="w", newline="") as f:
+            writer = csv.writer(f)
+            for index, chunk in enumerate(chunks):
+                _check_times(chunk)
+                names = [name for name in chunk if name != "labels"]
+                if index == 0:
+                    writer.writerow([CSV_COLUMNS.get(name, name) for name in names])
+                writer.writerows(zip(*_csv_values(chunk, names)))
+        return
+
+    directory = os.path.dirname(os.path.abspath(path))
+    spools = {}
+    partitioned_spools = {}
+    try:
+        rows = 0
+        labels = None
+        for chunk in chunks:
+            _check_times(chunk)
+            for name, values in chunk.items():
+                if name != "labels":
+                    _spool_column(spools, name, values, directory)
+            rows += len(chunk["time"])
+            labels = chunk.get("labels")
+        columns = _spooled_columns(spools, rows)
+        partitions = None
+        if partition:
+            if "label" not in columns:
+                raise ValueError("Only a labelled trace can be partitioned by label.")
+            partitions = _partition_spooled(columns, len(labels), partitioned_spools, directory)
+            columns = _spooled_columns(partitioned_spools, rows)
+        write_trace(path, columns, labels, partitions)
+    finally:
+        for spool in itertools.chain(spools.values(), partitioned_spools.values()):
+            spool.close()